@@ -3,6 +3,8 @@
 
 import sys
 import time
+import threading
+from collections import OrderedDict, namedtuple
 
 # All base glyphs.
 
@@ -138,6 +140,22 @@ POST_FEATURES = {
     '\u1dbb': 'affricated'
 }
 
+def _firstMatch(classes, names):
+    """Maps every glyph to the name of the first class containing it."""
+    result = {}
+    for glyphs, name in zip(classes, names):
+        for glyph in glyphs:
+            result.setdefault(glyph, name)
+    return result
+
+_MANNER_OF   = _firstMatch(MANNERS, MANNERS_NAMES)
+_PLACE_OF    = _firstMatch(PLACES, PLACES_NAMES)
+_POSITION_OF = _firstMatch(POSITIONS, POSITIONS_NAMES)
+_OPENNESS_OF = {} # Vowel -> all its openness names.
+for glyphs, name in zip(OPENNESS, OPENNESS_NAMES):
+    for glyph in glyphs:
+        _OPENNESS_OF.setdefault(glyph, []).append(name)
+
 def parseCons(phon):
     # print("".join(phon)) # For finding bugs in descriptions.
     attributes = set()
@@ -147,19 +165,15 @@ def parseCons(phon):
         phon = phon[0]
         if phon == '\u026b':
             attributes.add('velarised')   
-        for i in range(len(MANNERS)):
-            if phon in MANNERS[i]:
-                attributes.add(MANNERS_NAMES[i])
-                break
+        if phon in _MANNER_OF:
+            attributes.add(_MANNER_OF[phon])
     else:
         phon = phon[1]
         attributes.add('affricate')
         if phon in LATERAL_FRICATIVES:
             attributes.add('lateral')
-    for i in range(len(PLACES)):
-        if phon in PLACES[i]:
-            attributes.add(PLACES_NAMES[i])
-            break
+    if phon in _PLACE_OF:
+        attributes.add(_PLACE_OF[phon])
     if phon in VOICED:
         attributes.add('voiced')
     else:
@@ -185,13 +199,9 @@ def parseVow(phon):
         return attributes
     else:
         phon = phon[0]
-        for i in range(len(POSITIONS)):
-            if phon in POSITIONS[i]:
-                attributes.add(POSITIONS_NAMES[i])
-                break
-        for i in range(len(OPENNESS)):
-            if phon in OPENNESS[i]:
-                attributes.add(OPENNESS_NAMES[i])
+        if phon in _POSITION_OF:
+            attributes.add(_POSITION_OF[phon])
+        attributes.update(_OPENNESS_OF.get(phon, ()))
         if len(attributes) < 2:
             raise Exception("Vowel attributes under-parsed: " + phon)
         if phon in ROUNDED:
@@ -200,72 +210,168 @@ def parseVow(phon):
             attributes.add('unrounded')
         return attributes
 
-def parsePhon(phon):
-    if ' ' in phon.strip():
-        raise Exception('Blank space inside the phoneme! Check your commas: ' + phon)
-    # Catch non-standard symbols and ignore brackets.
-    replaceDict = {
-        'ŝ': 'ƺ', # Internal convention — exchange for a singe non-IPA symbol.
-        'ẑ': 'ʓ', # Idem.
-        'z̩': 'ɿ',  # To parse as a vowel.
-        'ʐ̩': 'ʅ',  # Idem.
-        'z̩ʷ': 'ʮ', # Idem.
-        'ʐ̩ʷ': 'ʯ', # Idem.
-        '(': '',    # For marginal phonemes. Don't use this unless you really have to.
-        ')': ''
-    } 
-    for key in replaceDict:
-        phon = phon.replace(key, replaceDict[key])
-    if len(phon) > 1:
-        phonoset = set(phon)
-        if 'w' in phonoset and phonoset.intersection(ALL_VOWELS):
-            phon = phon.replace('w', 'u\u032f')
-        elif 'ɰ' in phonoset and phonoset.intersection(ALL_VOWELS):
-            phon = phon.replace('ɰ', 'ɨ')
-        elif 'j' in phonoset and phonoset.intersection(ALL_VOWELS):
-            phon = phon.replace('j', 'i\u032f')
-    pre_attributes  = set()
-    core_attributes = set()
-    core_glyphs_vow = []
-    core_glyphs_con = []
-    post_attributes = set()
-    j = 0
-    # print(phon)
-    for i in range(len(phon)):
-        if phon[i] in MAIN_GLYPHS:
-            j = i
-            break
+# Tokenizer tables, compiled once from the tables above.
+
+# Non-standard symbols. The original code applied these one after another with
+# str.replace, so a pattern that contains an earlier one never fires: 'z̩ʷ' has
+# already become 'ɿʷ' by the time it is tried. _compileReplacements keeps that.
+REPLACEMENTS = [
+    ('ŝ', 'ƺ'), # Internal convention — exchange for a singe non-IPA symbol.
+    ('ẑ', 'ʓ'), # Idem.
+    ('z̩', 'ɿ'),  # To parse as a vowel.
+    ('ʐ̩', 'ʅ'),  # Idem.
+    ('z̩ʷ', 'ʮ'), # Idem.
+    ('ʐ̩ʷ', 'ʯ'), # Idem.
+    ('(', ''),    # For marginal phonemes. Don't use this unless you really have to.
+    (')', '')
+]
+
+# Glides are read as non-syllabic vowels when the phoneme has a vowel in it.
+# Only the first glide on this list which is present gets rewritten.
+GLIDE_VOWELS = [('w', 'u\u032f'), ('ɰ', 'ɨ'), ('j', 'i\u032f')]
+
+VOWEL_DIGRAPHS = {'e\u031e', 'ø\u031e', 'ɪ\u0308', 'ʊ\u0308', 'o\u031e', 'ɤ\u031e'}
+
+def _compileReplacements(replacements):
+    """Returns a dict from the first character of a pattern to the list of
+    (pattern, replacement) pairs starting with it, in the order of application."""
+    table = {}
+    for i in range(len(replacements)):
+        pattern, replacement = replacements[i]
+        if any(earlier in pattern for earlier, _ in replacements[:i]):
+            continue
+        table.setdefault(pattern[0], []).append((pattern, replacement))
+    return table
+
+_REPLACEMENT_TABLE = _compileReplacements(REPLACEMENTS)
+_GLIDE_REWRITES = [(glide, vowel, vowel[0], { POST_FEATURES[char] for char in vowel[1:] }) for glide, vowel in GLIDE_VOWELS]
+
+_VOWEL_CHAR = 1
+_GLIDE_CHAR = 2
+
+def _compileCharTable():
+    """Returns a dict from every character the tokenizer knows to a tuple
+    (is a core glyph, pre-feature, post-feature, replacements, digraph tails, flags)."""
+    chars = set(PRE_FEATURES) | set(POST_FEATURES) | set(_REPLACEMENT_TABLE) | {' '}
+    chars.update(glyph for glyph in MAIN_GLYPHS if len(glyph) == 1)
+    chars.update(glyph for glyph in ALL_VOWELS if len(glyph) == 1)
+    tails = {}
+    for digraph in VOWEL_DIGRAPHS:
+        tails.setdefault(digraph[0], set()).add(digraph[1])
+    glides = { glide for glide, _ in GLIDE_VOWELS }
+    table = {}
+    for char in chars:
+        flags = 0
+        if char in ALL_VOWELS:
+            flags |= _VOWEL_CHAR
+        elif char in glides:
+            flags |= _GLIDE_CHAR
+        table[char] = (
+            char in MAIN_GLYPHS,
+            PRE_FEATURES.get(char),
+            POST_FEATURES.get(char),
+            _REPLACEMENT_TABLE.get(char),
+            tails.get(char, ()) if char in MAIN_GLYPHS and char not in ALL_CONSONANTS else (),
+            flags
+        )
+    return table
+
+_CHAR_TABLE = _compileCharTable()
+_UNKNOWN_CHAR = (False, None, None, None, (), 0)
+
+def _tokenizePhon(phon):
+    """Reads phon in one left-to-right pass: applies REPLACEMENTS, splits the
+    characters into pre-features, core glyphs, and post-features, and rewrites
+    glides at the end. Returns (pre, core glyphs, post, normalised phon, error),
+    where error is None or a (position, char) pair pointing at the first
+    character that could not be parsed; char is None if no core glyph was found."""
+    pre   = set()
+    post  = set()
+    core  = []   # Core glyphs in order.
+    chars = []   # Normalised characters.
+    found = 0    # Flags of all characters seen.
+    tails = ()   # Characters which would make a vowel digraph with the previous one.
+    error = None
+    i = 0
+    length = len(phon)
+    while i < length:
+        position = i
+        char = phon[i]
+        i += 1
+        is_core, pre_feature, post_feature, replacements, next_tails, flags = _CHAR_TABLE.get(char, _UNKNOWN_CHAR)
+        if replacements is not None:
+            for pattern, replacement in replacements:
+                if phon.startswith(pattern, position):
+                    char = replacement
+                    i = position + len(pattern)
+                    is_core, pre_feature, post_feature, _, next_tails, flags = _CHAR_TABLE.get(char, _UNKNOWN_CHAR)
+                    break
+            if not char:
+                continue
+        chars.append(char)
+        found |= flags
+        if error is not None:
+            continue # Only the normalised string is needed now.
+        if is_core:
+            core.append(char)
+            tails = next_tails
+        elif char in tails:
+            core[-1] += char
+            tails = ()
         else:
-            if phon[i] in PRE_FEATURES:
-                pre_attributes.add(PRE_FEATURES[phon[i]])
-            else:
-                if phon[i] == ' ':
-                    continue
+            tails = ()
+            if char == ' ':
+                continue
+            if core:
+                if post_feature is None:
+                    error = (position, char)
                 else:
-                    raise Exception("Failed to parse a feature %s of phoneme %s" % (str(phon[i].encode("unicode_escape")).strip('b'), phon))
-    else:
-        raise Exception("No core features found in %s" % phon)
-    i = j
-    while i < len(phon):
-        if phon[i] in MAIN_GLYPHS:
-            if phon[i] in ALL_CONSONANTS:
-                core_glyphs_con.append(phon[i])
-            else:
-                if i < len(phon) - 1 and phon[ i : i + 2 ] in {'e\u031e', 'ø\u031e', 'ɪ\u0308', 'ʊ\u0308', 'o\u031e', 'ɤ\u031e'}:
-                    core_glyphs_vow.append(phon[ i : i + 2 ])
-                    i += 2
-                    continue
-                core_glyphs_vow.append(phon[i])
-        else:
-            if phon[i] not in POST_FEATURES and phon[i] != ' ':
-                raise Exception("Failed to parse a feature %s of phoneme %s" % (str(phon[i].encode("unicode_escape")).strip('b'), phon))
+                    post.add(post_feature)
+            elif pre_feature is None:
+                error = (position, char)
             else:
-                if phon[i] in POST_FEATURES and phon[i] != ' ':    
-                    post_attributes.add(POST_FEATURES[phon[i]])
-        i += 1
+                pre.add(pre_feature)
+    if error is None and not core:
+        error = (None, None)
+    normalised = ''.join(chars)
+    if found == _VOWEL_CHAR | _GLIDE_CHAR:
+        for glide, vowel, core_glyph, features in _GLIDE_REWRITES:
+            if glide in normalised:
+                normalised = normalised.replace(glide, vowel)
+                core = [core_glyph if glyph == glide else glyph for glyph in core]
+                post.update(features)
+                break
+    return pre, core, post, normalised, error
+
+def parsePhon(phon):
+    attributes, error = _parsePhon(phon)
+    if error is not None:
+        raise Exception(error[2])
+    return attributes
+
+def _parsePhon(phon):
+    """Does the work of parsePhon without raising. Returns (attributes, error):
+    attributes is the (pre, core, post) triple, or None if error is not None;
+    error is a (position, char, message) triple, where position and char are
+    None when the problem is not with a particular character."""
+    stripped = phon.strip()
+    if ' ' in stripped:
+        position = len(phon) - len(phon.lstrip()) + stripped.index(' ')
+        return None, (position, ' ', 'Blank space inside the phoneme! Check your commas: ' + phon)
+    pre_attributes, core_glyphs, post_attributes, phon, error = _tokenizePhon(phon)
+    if error is not None:
+        position, char = error
+        if char is None:
+            return None, (None, None, "No core features found in %s" % phon)
+        return None, (position, char, "Failed to parse a feature %s of phoneme %s" % (str(char.encode("unicode_escape")).strip('b'), phon))
+    core_attributes = set()
+    core_glyphs_con = [glyph for glyph in core_glyphs if glyph in ALL_CONSONANTS]
+    core_glyphs_vow = [glyph for glyph in core_glyphs if glyph not in ALL_CONSONANTS]
     if core_glyphs_con and core_glyphs_vow:
-        raise Exception("Conflicting features error: " + "".join(phon))
+        return None, (None, None, "Conflicting features error: " + "".join(phon))
     elif core_glyphs_vow:
+        if len(core_glyphs_vow) > 3:
+            return None, (None, None, "Too long a sequence: " + "".join(core_glyphs_vow))
         core_attributes.add('vowel')
         core_attributes.update(parseVow(core_glyphs_vow))
     elif core_glyphs_con:
@@ -273,6 +379,8 @@ def parsePhon(phon):
         if core_glyphs_con[0] in {'n', 'ɲ', 'ɳ', 'ɴ'} and len(core_glyphs_con) > 1:
             pre_attributes.add(PRE_FEATURES['\u207f'])
             core_glyphs_con = core_glyphs_con[1:]
+        if len(core_glyphs_con) > 2:
+            return None, (None, None, "Too long a sequence: " + "".join(core_glyphs_con))
         core_attributes.update(parseCons(core_glyphs_con))
     # Check for diacritic-induced voiced-voiceless conflict.
     if 'voiceless' in post_attributes:
@@ -315,7 +423,175 @@ def parsePhon(phon):
         post_attributes.remove('alveolar')
         core_attributes.discard('dental')
         core_attributes.add('alveolar')
-    return pre_attributes, core_attributes, post_attributes
+    return (pre_attributes, core_attributes, post_attributes), None
+
+# Bitmask encoding of feature sets.
+
+# The closed vocabulary of features parsePhon can produce. Polyphthongs also
+# carry their own glyph string as a feature; these get bits on demand.
+FEATURE_NAMES = []
+for _name in (['consonant', 'vowel'] + MANNERS_NAMES + ['affricate', 'lateral', 'lateral_affricate', 'non_lateral']
+        + PLACES_NAMES + ['dental', 'voiced', 'voiceless', 'lenis'] + OPENNESS_NAMES + POSITIONS_NAMES
+        + ['rounded', 'unrounded', 'apical', 'diphthong', 'triphthong']
+        + list(PRE_FEATURES.values()) + list(POST_FEATURES.values())):
+    if _name not in FEATURE_NAMES:
+        FEATURE_NAMES.append(_name)
+del _name
+
+class FeatureEncoder:
+    """Maps sets of features to integer bitmasks, so that a superset test
+    becomes mask & query == query."""
+    def __init__(self, names = FEATURE_NAMES):
+        self.bits  = {} # Feature -> bit.
+        self.names = [] # Bit position -> feature.
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name not in self.bits:
+            self.bits[name] = 1 << len(self.names)
+            self.names.append(name)
+        return self.bits[name]
+
+    def encode(self, features, grow = True):
+        """Returns the bitmask of features. Unknown features get new bits if
+        grow is set; otherwise None is returned, since no encoded phoneme can
+        have them."""
+        mask = 0
+        for name in features:
+            bit = self.bits.get(name)
+            if bit is None:
+                if not grow:
+                    return None
+                bit = self.add(name)
+            mask |= bit
+        return mask
+
+    def decode(self, mask):
+        result = set()
+        i = 0
+        while mask:
+            if mask & 1:
+                result.add(self.names[i])
+            mask >>= 1
+            i += 1
+        return frozenset(result)
+
+# Parse cache.
+
+_INTERNED = {} # Frozenset -> the same frozenset, so that equal feature sets are shared.
+
+def internFeatures(features):
+    """Returns the canonical copy of a frozenset of features."""
+    features = frozenset(features)
+    return _INTERNED.setdefault(features, features)
+
+def _sharedFeatures(features):
+    """Like internFeatures, but does not grow the interning table."""
+    features = frozenset(features)
+    return _INTERNED.get(features, features)
+
+class ParseCache:
+    """Memoizes parsePhon. Each distinct glyph string is parsed once, and its
+    pre, core, and post features together with their union are stored as
+    interned frozensets, so that all callers share the same objects.
+    With maxsize set the cache is an LRU of that size, which is what we want
+    for query input; a bounded cache can consult an unbounded fallback cache
+    first, but never adds to the global interning table."""
+    def __init__(self, maxsize = None, fallback = None):
+        self.maxsize   = maxsize
+        self.fallback  = fallback
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._entries  = OrderedDict() # Glyph -> (pre, core, post, key, error)
+        self._lock     = threading.Lock()
+
+    def _lookup(self, phon):
+        if self.maxsize is None:
+            entry = self._entries.get(phon)
+        else:
+            with self._lock:
+                entry = self._entries.get(phon)
+                if entry is not None:
+                    self._entries.move_to_end(phon)
+        if entry is None and self.fallback is not None:
+            entry = self.fallback._entries.get(phon)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        share = internFeatures if self.maxsize is None else _sharedFeatures
+        attributes, error = _parsePhon(phon)
+        if error is None:
+            pre, core, post = attributes
+            entry = (share(pre), share(core), share(post), share(set.union(pre, core, post)), None)
+        else:
+            entry = (None, None, None, None, error) # Bad glyphs are remembered too.
+        with self._lock:
+            self._entries[phon] = entry
+            if self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+        return entry
+
+    def parse(self, phon):
+        """Returns pre, core, and post features of phon as frozensets."""
+        entry = self._lookup(phon)
+        if entry[4] is not None:
+            raise Exception(entry[4][2])
+        return entry[:3]
+
+    def key(self, phon):
+        """Returns the frozenset of all features of phon."""
+        entry = self._lookup(phon)
+        if entry[4] is not None:
+            raise Exception(entry[4][2])
+        return entry[3]
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+# Glyphs from the database go to the shared cache; user input goes to
+# the bounded one, which still answers from the shared cache for free.
+PARSE_CACHE       = ParseCache()
+QUERY_PARSE_CACHE = ParseCache(maxsize = 4096, fallback = PARSE_CACHE)
+
+# Batch parsing.
+
+ParsedPhoneme = namedtuple('ParsedPhoneme', ['glyph', 'pre', 'core', 'post', 'key'])
+
+# index: position of the glyph in the inventory; position: offset of the
+# offending character in the glyph; codepoint: that character as 'U+XXXX'.
+# Position and codepoint are None when no single character is to blame.
+ParseError = namedtuple('ParseError', ['index', 'glyph', 'position', 'codepoint', 'reason'])
+
+def parse_inventory(glyphs, cache = PARSE_CACHE):
+    """Parses a whole inventory without raising. Returns (parsed, errors),
+    a list of ParsedPhoneme for the good glyphs and a list of ParseError
+    for the bad ones. Use QUERY_PARSE_CACHE for user input."""
+    parsed = []
+    errors = []
+    for index, glyph in enumerate(glyphs):
+        pre, core, post, key, error = cache._lookup(glyph)
+        if error is None:
+            parsed.append(ParsedPhoneme(glyph, pre, core, post, key))
+        else:
+            position, char, reason = error
+            codepoint = None if char is None else 'U+%04X' % ord(char)
+            errors.append(ParseError(index, glyph, position, codepoint, reason))
+    return parsed, errors
 
 # Testing code.
 
@@ -3,7 +3,7 @@
 import sys
 import re
 from io import StringIO
-from IPAParser import parsePhon
+from IPAParser import parse_inventory
 
 SERIES_FORMING_FEATURES = {'pre-glottalised', 'pre-aspirated', 'pre-aspirated', 'pre-nasalised', 'pre-labialised', 'pharyngealised', 'nasalised', 'labialised', 'velarised', 'faucalised', 'palatalised', 'half-long', 'long', 'creaky-voiced', 'breathy-voiced', 'lateral-released', 'rhotic', 'advanced-tongue-root', 'retracted-tongue-root'}
 
@@ -19,11 +19,11 @@ class Phoneme:
     to put the phoneme in."""
     def __init__(self, phon, preSet, coreSet, postSet):
         self.phon      = phon
-        self.coreSet   = coreSet
+        self.coreSet   = set(coreSet) # Parses may be shared, so never update them in place.
         self.seriesSet = frozenset(
-            SERIES_FORMING_FEATURES.intersection(set.union(preSet, postSet))
+            SERIES_FORMING_FEATURES.intersection(preSet | postSet)
             )
-        self.coreSet.update(set.difference(set.union(preSet, postSet), self.seriesSet))
+        self.coreSet.update((preSet | postSet) - self.seriesSet)
         self.coreSet = frozenset(self.coreSet)
 
     def __str__(self):
@@ -148,9 +148,11 @@ def processInventory(idiomName, phonoString, with_title):
     apical_vowels = []
 
     inputPhons = re.split(r'\s*,\s*', phonoString)
+    parsed, errors = parse_inventory(inputPhons)
 
-    for phon in inputPhons:
-        phoneme = Phoneme(phon, *parsePhon(phon))
+    for item in parsed:
+        phon = item.glyph
+        phoneme = Phoneme(phon, item.pre, item.core, item.post)
         if 'consonant' in phoneme.coreSet:
             consonants.append(phoneme)
             if phoneme.seriesSet:
@@ -207,6 +209,9 @@ def processInventory(idiomName, phonoString, with_title):
     if triphthongs:
         out.write("<h5>Triphthongs:</h5>")
         out.write("<p>" + ", ".join(str(el) for el in triphthongs))
+    if errors:
+        out.write("<h5>Unparsed segments:</h5>")
+        out.write("<p>" + ", ".join(error.glyph for error in errors))
     if with_title:
         out.write('</div>')
 
@@ -225,9 +230,11 @@ def tabulateAllSegments(phonoString):
     apical_vowels = []
 
     inputPhons = re.split(r'\s*,\s*', phonoString)
+    parsed, errors = parse_inventory(inputPhons)
 
-    for phon in inputPhons:
-        phoneme = Phoneme(phon, *parsePhon(phon))
+    for item in parsed:
+        phon = item.glyph
+        phoneme = Phoneme(phon, item.pre, item.core, item.post)
         if 'consonant' in phoneme.coreSet:
             consonants.append(phoneme)
             if phoneme.seriesSet:
@@ -281,6 +288,9 @@ def tabulateAllSegments(phonoString):
     if triphthongs:
         out.write("<h3>Triphthongs:</h3>")
         out.write("<p>" + ", ".join(spanify(el) for el in triphthongs))
+    if errors:
+        out.write("<h3>Unparsed segments:</h3>")
+        out.write("<p>" + ", ".join(error.glyph for error in errors))
     return out.getvalue()
 
 
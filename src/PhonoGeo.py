@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Spatial index over the coordinates of the languages of a
+LangSearchEngine: languages within a radius, in a bounding box, and
+nearest to a point, and languages binned into cells for maps.
+
+Coordinates are parsed once into arrays of floats and bucketed into a grid
+of cell_size × cell_size degree cells. A query only looks at the cells
+overlapping the bounding box of its area; longitudes wrap around at ±180°.
+Distances are great-circle distances in kilometres."""
+
+import math
+import heapq
+from array import array
+
+EARTH_RADIUS = 6371.0088 # Mean radius, km.
+HALF_CIRCUMFERENCE = math.pi * EARTH_RADIUS
+CELLS_PER_TILE = 4 # Map cells across a 256-pixel tile, i.e. about 64 pixels each.
+
+def distance(lat1, lon1, lat2, lon2):
+    """Haversine distance in km between two points given in degrees."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def zoom_cell_size(zoom):
+    """Size in degrees of the map cells at a zoom level of a web map, where
+    one tile spans 360 / 2 ** zoom degrees of longitude."""
+    return 360 / 2 ** zoom / CELLS_PER_TILE
+
+def in_box(lat, lon, south, west, north, east):
+    """Whether a point is in a box; west > east means the box crosses the
+    180th meridian."""
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lon <= east
+    return lon >= west or lon <= east
+
+class SpatialIndex:
+    def __init__(self, coords, cell_size = 2.0):
+        """coords is a dict like engine.coord_dic: lang -> (lat, lon), as
+        strings or numbers."""
+        self.cell_size = cell_size
+        self.ncols = int(math.ceil(360 / cell_size))
+        self.langs = list(coords)
+        self.rows  = { lang: i for i, lang in enumerate(self.langs) }
+        self.lats  = array('d', (float(coords[lang][0]) for lang in self.langs))
+        self.lons  = array('d', (float(coords[lang][1]) for lang in self.langs))
+        self.cells = {} # (lat cell, lon cell) -> row numbers.
+        for i in range(len(self.langs)):
+            self.cells.setdefault(self._cell(self.lats[i], self.lons[i]), []).append(i)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)), int(math.floor((lon + 180) / self.cell_size)) % self.ncols)
+
+    def coords(self, lang):
+        i = self.rows[lang]
+        return self.lats[i], self.lons[i]
+
+    def _rows_in_box(self, south, north, west, east):
+        """Row numbers in the cells overlapping a box; west > east means
+        the box crosses the 180th meridian, and None for both means all
+        longitudes."""
+        first_row = int(math.floor(south / self.cell_size))
+        last_row  = int(math.floor(north / self.cell_size))
+        if west is None:
+            columns = range(self.ncols)
+        else:
+            first_col = int(math.floor((west + 180) / self.cell_size))
+            last_col  = int(math.floor((east + 180) / self.cell_size))
+            if west > east:
+                last_col += self.ncols
+            columns = [col % self.ncols for col in range(first_col, min(last_col, first_col + self.ncols - 1) + 1)]
+        result = []
+        for row in range(first_row, last_row + 1):
+            for col in columns:
+                result.extend(self.cells.get((row, col), ()))
+        return result
+
+    def in_bbox(self, south, west, north, east, langs = None):
+        """Returns the set of languages in a box; west > east means the box
+        crosses the 180th meridian. langs, if given, restricts the result."""
+        result = set()
+        for i in self._rows_in_box(south, north, west, east):
+            if not in_box(self.lats[i], self.lons[i], south, west, north, east):
+                continue
+            if langs is None or self.langs[i] in langs:
+                result.add(self.langs[i])
+        return result
+
+    def within(self, lat, lon, radius, langs = None):
+        """Returns (distance, lang) pairs for the languages at most radius km
+        from a point, nearest first."""
+        angle = radius / EARTH_RADIUS # In radians.
+        south = lat - math.degrees(angle)
+        north = lat + math.degrees(angle)
+        if south <= -90 or north >= 90 or angle >= math.pi / 2:
+            west = east = None # A pole is within the radius.
+        else:
+            ratio = math.sin(angle) / math.cos(math.radians(lat))
+            if ratio >= 1:
+                west = east = None
+            else:
+                half_width = math.degrees(math.asin(ratio))
+                west = (lon - half_width + 180) % 360 - 180
+                east = (lon + half_width + 180) % 360 - 180
+        result = []
+        for i in self._rows_in_box(max(south, -90), min(north, 90), west, east):
+            if langs is not None and self.langs[i] not in langs:
+                continue
+            dist = distance(lat, lon, self.lats[i], self.lons[i])
+            if dist <= radius:
+                result.append((dist, self.langs[i]))
+        result.sort()
+        return result
+
+    def nearest(self, lat, lon, k = 10, langs = None, start_radius = 250.0):
+        """Returns (distance, lang) pairs for the k languages nearest to a
+        point, nearest first. Searches within growing radii until k
+        languages are found."""
+        radius = start_radius
+        while True:
+            found = self.within(lat, lon, radius, langs)
+            if len(found) >= k or radius >= HALF_CIRCUMFERENCE:
+                return heapq.nsmallest(k, found)
+            radius *= 2
+
+    def clusters(self, cell_size, langs = None, labels = None):
+        """Bins the languages (all or langs) into cell_size × cell_size
+        degree cells. Returns a list of [lat, lon, count, {label: count},
+        lang] for the non-empty cells, largest first: the mean coordinates
+        of the languages in the cell, their number, their numbers by labels
+        (a dict lang -> label, e.g. the family), and the language itself if
+        it is alone in the cell (None otherwise)."""
+        if langs is None:
+            rows = range(len(self.langs))
+        else:
+            rows = (self.rows[lang] for lang in langs if lang in self.rows)
+        cells = {}
+        for i in rows:
+            lat, lon = self.lats[i], self.lons[i]
+            cell = (int(math.floor(lat / cell_size)), int(math.floor((lon + 180) / cell_size)))
+            entry = cells.get(cell)
+            if entry is None:
+                entry = cells[cell] = [0, 0.0, 0.0, {}, self.langs[i]]
+            entry[0] += 1
+            entry[1] += lat
+            entry[2] += lon
+            if labels is not None:
+                label = labels[self.langs[i]]
+                entry[3][label] = entry[3].get(label, 0) + 1
+        result = []
+        for count, lat_sum, lon_sum, breakdown, lang in cells.values():
+            breakdown = dict(sorted(breakdown.items(), key = lambda item: (-item[1], item[0])))
+            result.append([round(lat_sum / count, 4), round(lon_sum / count, 4), count, breakdown, lang if count == 1 else None])
+        result.sort(key = lambda cell: (-cell[2], cell[0], cell[1]))
+        return result
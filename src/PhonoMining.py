@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Frequent phoneme sets: bundles of phonemes found together in many
+inventories (series like pʰ tʰ kʰ, sets of retroflexes, etc.).
+
+Usage: python3 PhonoMining.py [path] [--min-support S] [--max-size N]
+                              [--family F] [--no-dialects] [--processes N]
+
+Apriori: frequent sets of size k are extended by one phoneme, keeping only
+candidates all of whose subsets of size k are frequent, and counted again.
+Supports are counted on the language bitsets of the engine (the support of
+a set is the number of bits in the AND of its phonemes' bitsets), and each
+level is spread over a process pool by blocks of sets sharing a prefix."""
+
+import sys
+import time
+import argparse
+from multiprocessing import Pool, cpu_count
+
+# Set in each worker: frequent sets of the previous level -> bitsets, and
+# the smallest support to keep.
+_level = {}
+_min_support = 0
+
+def setState(level, min_support):
+    global _level, _min_support
+    _level = level
+    _min_support = min_support
+
+def extendBlocks(blocks):
+    """Joins the sets in each block (sets differing only in their last
+    item), prunes, and counts. Returns a list of (itemset, bitset, support)."""
+    result = []
+    for block in blocks:
+        for i, first in enumerate(block):
+            first_bits = _level[first]
+            for second in block[i + 1:]:
+                candidate = first + second[-1:]
+                # Every subset one smaller must be frequent; the two we
+                # joined are, so check the others.
+                if any(candidate[:j] + candidate[j + 1:] not in _level for j in range(len(candidate) - 2)):
+                    continue
+                bits = first_bits & _level[second]
+                support = bin(bits).count('1')
+                if support >= _min_support:
+                    result.append((candidate, bits, support))
+    return result
+
+def _blocks(level):
+    """Groups sorted itemsets by everything but their last item."""
+    blocks = {}
+    for itemset in sorted(level):
+        blocks.setdefault(itemset[:-1], []).append(itemset)
+    return [block for block in blocks.values() if len(block) > 1]
+
+def mine(engine, min_support = 0.1, max_size = 3, langs = None, processes = None):
+    """Returns a list of (glyphs, support) for all sets of at most max_size
+    phonemes present together in at least min_support of the languages
+    (a proportion if below 1, else a number of languages), largest
+    support first within each size. langs restricts the search to some
+    languages."""
+    if langs is None:
+        langs = list(engine.inv_dic)
+    mask = 0
+    for lang in langs:
+        mask |= 1 << engine.lang_ids[lang]
+    if min_support < 1:
+        min_support = max(1, int(-(-min_support * len(langs) // 1)))
+    processes = processes or cpu_count()
+
+    # Items are numbered in the order of their glyphs, so that itemsets are
+    # sorted tuples of numbers.
+    items = []
+    for key, bits in engine.phoneme_bits.items():
+        bits &= mask
+        if bin(bits).count('1') >= min_support:
+            items.append((engine.all_phonemes[key], bits))
+    items.sort()
+    glyphs = [glyph for glyph, bits in items]
+    level = { (i,): bits for i, (glyph, bits) in enumerate(items) }
+    found = sorted((((glyph,), bin(bits).count('1')) for glyph, bits in items), key = lambda item: (-item[1], item[0]))
+
+    size = 1
+    while level and size < max_size:
+        size += 1
+        blocks = _blocks(level)
+        if not blocks:
+            break
+        chunks = [blocks[i::processes * 4] for i in range(processes * 4)]
+        chunks = [chunk for chunk in chunks if chunk]
+        candidates = sum(len(block) * (len(block) - 1) // 2 for block in blocks)
+        if processes > 1 and len(chunks) > 1 and candidates > 20000:
+            with Pool(processes, initializer = setState, initargs = (level, min_support)) as pool:
+                results = pool.map(extendBlocks, chunks)
+        else:
+            setState(level, min_support)
+            results = [extendBlocks(chunk) for chunk in chunks]
+        level = {}
+        level_found = []
+        for chunk_result in results:
+            for itemset, bits, support in chunk_result:
+                level[itemset] = bits
+                level_found.append((tuple(glyphs[i] for i in itemset), support))
+        level_found.sort(key = lambda item: (-item[1], item[0]))
+        found.extend(level_found)
+    return found
+
+def main():
+    from PhonoSearchLib import LangSearchEngine
+    parser = argparse.ArgumentParser(description = "Find sets of phonemes frequently found together.")
+    parser.add_argument("path", nargs = "?", default = "dbase/phono_dbase.json")
+    parser.add_argument("--min-support", type = float, default = 0.1, help = "proportion (below 1) or number of languages (default: 0.1)")
+    parser.add_argument("--max-size", type = int, default = 3)
+    parser.add_argument("--family", default = None)
+    parser.add_argument("--no-dialects", action = "store_true")
+    parser.add_argument("--processes", type = int, default = None, help = "size of the process pool (default: number of CPUs)")
+    args = parser.parse_args()
+    engine = LangSearchEngine(args.path)
+    langs = engine._subset(args.family, None, not args.no_dialects)
+    start = time.perf_counter()
+    found = mine(engine, args.min_support, args.max_size, langs, args.processes)
+    for glyphs, support in found:
+        print("%s\t%d\t%.3f" % (' '.join(glyphs), support, support / len(langs)))
+    print("%d sets in %.2f s" % (len(found), time.perf_counter() - start), file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
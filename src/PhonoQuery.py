@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Boolean queries over phonemes and features.
+
+    (ʈ OR ɖ) AND NOT retroflex fricative
+    ɬ, -lateral affricate
+    p* AND (q OR ʔ)
+
+Atoms are phonemes in IPA, which match exactly (p* also matches all the
+derivatives of p), and features, which are one or more feature names in a
+row and match languages having a phoneme with all of them. NOT binds
+tighter than AND, and AND tighter than OR; a comma is another way of
+writing AND and a leading '-' another way of writing NOT, so the lists
+taken by the other searches are valid queries too.
+
+A query is parsed once into a plan made of nested tuples:
+
+    ('and', frozenset of plans)
+    ('or', frozenset of plans)
+    ('not', plan)
+    ('phoneme', features of the phoneme)
+    ('fuzzy', features of the phoneme)
+    ('feature', frozenset of feature names)
+
+Plans do not depend on the order or repetition of terms, so they can be
+used as cache keys, and are evaluated against the language bitsets of a
+LangSearchEngine."""
+
+import re
+import IPAParser
+
+KEYWORDS = { 'AND': 'and', 'OR': 'or', 'NOT': 'not' }
+FEATURES = set(IPAParser.FEATURE_NAMES)
+
+_TOKEN = re.compile(r'\s*(?:([(),])|([^\s(),]+))')
+
+def tokenize(text):
+    """Returns a list of tokens: '(', ')', 'and', 'or', 'not', and
+    ('word', string) pairs."""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        position = match.end()
+        if match.group(1):
+            tokens.append('and' if match.group(1) == ',' else match.group(1))
+            continue
+        word = match.group(2)
+        if word.upper() in KEYWORDS:
+            tokens.append(KEYWORDS[word.upper()])
+            continue
+        while word.startswith('-'):
+            tokens.append('not')
+            word = word[1:]
+        if word:
+            tokens.append(('word', word))
+    return tokens
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise Exception("Nothing to search for")
+        plan = self.parse_or()
+        if self.peek() is not None:
+            raise Exception("Unexpected %s" % _describe(self.peek()))
+        return plan
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == 'or':
+            self.next()
+            operands.append(self.parse_and())
+        return _combine('or', operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.peek() == 'and':
+            self.next()
+            operands.append(self.parse_not())
+        return _combine('and', operands)
+
+    def parse_not(self):
+        token = self.next()
+        if token == 'not':
+            operand = self.parse_not()
+            if operand[0] == 'not':
+                return operand[1]
+            return ('not', operand)
+        if token == '(':
+            plan = self.parse_or()
+            if self.next() != ')':
+                raise Exception("Missing ')'")
+            return plan
+        if isinstance(token, tuple):
+            words = [token[1]]
+            while isinstance(self.peek(), tuple):
+                words.append(self.next()[1])
+            return _atom(words)
+        if token is None:
+            raise Exception("Unexpected end of query")
+        raise Exception("Unexpected %s" % _describe(token))
+
+def _describe(token):
+    if isinstance(token, tuple):
+        return "‘%s’" % token[1]
+    return "‘%s’" % token.upper() if token in ('and', 'or', 'not') else "‘%s’" % token
+
+def _combine(operator, operands):
+    """Flattens nested operators of the same kind and drops duplicates."""
+    result = set()
+    for operand in operands:
+        if operand[0] == operator:
+            result.update(operand[1])
+        else:
+            result.add(operand)
+    if len(result) == 1:
+        return result.pop()
+    return (operator, frozenset(result))
+
+def _atom(words):
+    if all(word in FEATURES for word in words):
+        return ('feature', frozenset(words))
+    if len(words) > 1:
+        unknown = [word for word in words if word not in FEATURES]
+        raise Exception("Unknown feature ‘%s’ (or a missing operator)" % unknown[0])
+    glyph = words[0]
+    kind = 'phoneme'
+    if glyph.endswith('*'):
+        kind = 'fuzzy'
+        glyph = glyph[:-1]
+    return (kind, IPAParser.QUERY_PARSE_CACHE.key(glyph))
+
+def parse_query(text):
+    """Returns the plan for a query string. Raises an Exception with a
+    message fit for the user if the query is malformed."""
+    return _Parser(text).parse()
+
+def phoneme_glyphs(text):
+    """Returns the phoneme atoms of a query as they were typed, without the
+    trailing '*', so that they can be checked before parsing the query."""
+    result = []
+    tokens = tokenize(text)
+    i = 0
+    while i < len(tokens):
+        if not isinstance(tokens[i], tuple):
+            i += 1
+            continue
+        words = []
+        while i < len(tokens) and isinstance(tokens[i], tuple):
+            words.append(tokens[i][1])
+            i += 1
+        if len(words) == 1 and words[0] not in FEATURES:
+            result.append(words[0].rstrip('*'))
+    return result
+
+def evaluate(engine, plan, with_dialects = True):
+    """Returns the set of languages matching a plan."""
+    return engine._bits2langs(evaluate_bits(engine, plan, with_dialects))
+
+def evaluate_bits(engine, plan, with_dialects = True):
+    """Returns the bitset of languages matching a plan."""
+    universe = engine.lang_mask(with_dialects)
+    return _evaluate(engine, plan, universe) & universe
+
+def _estimate(engine, plan):
+    kind = plan[0]
+    if kind == 'phoneme':
+        return len(engine.phoneme_index.get(plan[1], ()))
+    if kind in ('fuzzy', 'feature'):
+        return engine._features_estimate(plan[1])
+    if kind == 'and':
+        return min(_estimate(engine, operand) for operand in plan[1])
+    if kind == 'or':
+        return sum(_estimate(engine, operand) for operand in plan[1])
+    return len(engine.inv_dic) # 'not'
+
+def _evaluate(engine, plan, universe):
+    kind = plan[0]
+    if kind == 'phoneme':
+        return engine.phoneme_bits.get(plan[1], 0)
+    if kind in ('fuzzy', 'feature'):
+        return engine._keys2bits(engine._superset_keys(plan[1]))
+    if kind == 'not':
+        return universe & ~_evaluate(engine, plan[1], universe)
+    if kind == 'or':
+        result = 0
+        for operand in plan[1]:
+            result |= _evaluate(engine, operand, universe)
+            if result & universe == universe:
+                break
+        return result
+    # 'and': the rarest positive operands first, negations last and only
+    # on what is left.
+    positive = sorted((operand for operand in plan[1] if operand[0] != 'not'), key = lambda operand: _estimate(engine, operand))
+    negative = [operand[1] for operand in plan[1] if operand[0] == 'not']
+    result = universe
+    for operand in positive:
+        result &= _evaluate(engine, operand, universe)
+        if not result:
+            return result
+    for operand in negative:
+        result &= ~_evaluate(engine, operand, universe)
+        if not result:
+            break
+    return result
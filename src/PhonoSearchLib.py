@@ -1,8 +1,20 @@
 import IPAParser
+import PhonoGeo
+import PhonoQuery
+import PhonoSimilarity
 import re
+import os
+import gc
 import csv
 import json
+import pickle
 import pprint
+import heapq
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
 from io import StringIO
 from IPATabulator import CONS_ROW_NAMES, CONS_COL_NAMES
 from IPATabulator import VOW_ROW_NAMES, VOW_COL_NAMES
@@ -10,10 +22,29 @@ from IPATabulator import processInventory, tabulateAllSegments
 
 CONS_COL_NAMES.append('interdental')
 
+# Bump when the attributes of LangSearchEngine or the output of the parser
+# change, so that old snapshots are rebuilt.
+SNAPSHOT_VERSION = 11
+
+_VERSIONS = itertools.count(1)
+
 class LangSearchEngine:
-    def __init__(self, path, with_dialects):
-        with open(path, 'r', encoding = 'utf-8') as inp:
-            self.lang_dic = json.load(inp)
+    """Dialects are loaded unless with_dialects is False; query methods
+    take their own with_dialects argument to leave out the loaded ones.
+
+    If snapshot is a path, the built engine is saved there and later
+    engines are loaded from it instead of being rebuilt, for as long as
+    the database file and the options stay the same. Snapshots are
+    pickles, so the path must be one only trusted users can write to."""
+    def __init__(self, path, with_dialects = True, with_masks = False, snapshot = None):
+        with open(path, 'rb') as inp:
+            source = inp.read()
+        self.source_hash   = hashlib.sha256(source).hexdigest()
+        self.with_dialects = with_dialects
+        if snapshot is not None and self.load_snapshot(snapshot, with_masks):
+            self.version = next(_VERSIONS)
+            return
+        self.lang_dic = json.loads(source.decode('utf-8'))
         if not with_dialects:
             entries_for_deletion = []
             for key in self.lang_dic:
@@ -28,9 +59,38 @@ class LangSearchEngine:
         self.group_dic    = {}
         self.inv_dic      = {}
         self.non_systematic   = {} # Phonemes which we cannot put in the table.
+        self.phoneme_cells    = {} # Frozenset -> the table cell (or non_systematic) it is kept in.
+        self.phoneme_index    = {} # Frozenset -> list of langs, for all phonemes.
+        self.feature_index    = {} # Feature -> set of frozensets having it.
+        self.feature_counts   = {} # Feature -> {lang: number of its phonemes with the feature}.
+
+        # Languages are numbered in the order they are added, and sets of
+        # languages are kept as integer bitsets over these numbers.
+        self.lang_ids       = {} # Lang -> bit number.
+        self.lang_list      = [] # Bit number -> lang.
+        self.all_langs_bits = 0
+        self.phoneme_bits   = {} # Frozenset -> bitset of langs.
+        self.dialects       = set()
+        self.dialect_bits   = 0
+        self._genealogy_wo_dialects = None # Filtered phyla, family and group dicts.
+
+        # Changes on every change, so that results computed from the engine
+        # can be cached under (version, query); no two engines in a process
+        # share a version.
+        self.version = next(_VERSIONS)
+
+        # Structures derived from the whole engine, built on demand and
+        # dropped on every change: see _derived_defaults.
+        self._drop_derived()
+        self._feature_lang_counts = {} # Feature -> number of langs, for query plans.
+        self.parse_errors     = {} # Lang -> ParseErrors for glyphs left out of its inventory.
         self.coord_dic        = {} # For map.
         self.family_group_dic = {} # Idem.
 
+        # Optional bitmask encoding of phonemes for the *_mask_query methods.
+        self.encoder  = IPAParser.FeatureEncoder() if with_masks else None
+        self.mask_dic = {} # Bitmask -> [glyph, list of langs].
+
         # Prepairing tables for lookup.
         self.cons_table = [[{} for i in CONS_COL_NAMES] for j in CONS_ROW_NAMES]
         self.cons_x_coords = {}
@@ -53,60 +113,190 @@ class LangSearchEngine:
         
         # Adding languages.
         for key in self.lang_dic:
-            self.add_language(key, self.lang_dic[key]["inv"])
+            self._add_record(key)
 
-            self.coord_dic[key] = self.lang_dic[key]["coords"]
-            self.family_group_dic[key] = self.lang_dic[key]["gen"]
+        if snapshot is not None:
+            self.save_snapshot(snapshot)
 
-            family = self.lang_dic[key]["gen"][0]
-            if self.lang_dic[key]["gen"][1]:
-                group = self.lang_dic[key]["gen"][1]
-            else:
-                group = family + "_ungrouped"
-
-            # Which families contain which groups.
-            if family not in self.phyla_dic:
-                self.phyla_dic[family] = set()
-            if group:
-                self.phyla_dic[family].add(group)
-            
-            # Which families and groups contain which langs.
-            if not family in self.family_dic:
-                self.family_dic[family] = []
-            self.family_dic[family].append(key)
-            if not group in self.group_dic:
-                self.group_dic[group] = []
-            self.group_dic[group].append(key)
+    def _snapshot_header(self, with_masks):
+        return {
+            "version": SNAPSHOT_VERSION,
+            "source_hash": self.source_hash,
+            "with_dialects": self.with_dialects,
+            "with_masks": with_masks
+        }
+
+    def save_snapshot(self, path):
+        """Pickles the engine to path: a header as one line of JSON and then
+        the state, so that a stale snapshot can be detected without
+        unpickling anything. Caches are not saved. Returns False if the
+        file cannot be written."""
+        state = dict(self.__dict__)
+        state.update(self._derived_defaults())
+        state["_feature_lang_counts"] = {}
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as out:
+                out.write(json.dumps(self._snapshot_header(self.encoder is not None)).encode('utf-8') + b'\n')
+                pickle.dump(state, out, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path) # Readers never see a half-written file.
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    def load_snapshot(self, path, with_masks = False):
+        """Loads the state saved by save_snapshot, provided that it was made
+        from the same database with the same options. Returns False if
+        there is no usable snapshot. The state is unpickled, which can run
+        arbitrary code, so the snapshot must come from a trusted place; the
+        header is checked before that."""
+        try:
+            with open(path, 'rb') as inp:
+                if json.loads(inp.readline(4096).decode('utf-8')) != self._snapshot_header(with_masks):
+                    return False
+                # The state is millions of small objects, and the collector
+                # would otherwise run over them again and again while loading.
+                gc.disable()
+                try:
+                    state = pickle.load(inp)
+                finally:
+                    gc.enable()
+        except Exception:
+            return False # Missing, truncated, or from an incompatible version.
+        self.__dict__.update(state)
+        return True
+
+    def _add_record(self, key):
+        """Adds the language with the record self.lang_dic[key]."""
+        self.add_language(key, self.lang_dic[key]["inv"])
+        if self.lang_dic[key]["type"] == "Диалект":
+            self.dialects.add(key)
+            self.dialect_bits |= 1 << self.lang_ids[key]
+
+        self.coord_dic[key] = self.lang_dic[key]["coords"]
+        self.family_group_dic[key] = self.lang_dic[key]["gen"]
+        self._add_to_genealogy(key, self.phyla_dic, self.family_dic, self.group_dic)
+
+    def _add_to_genealogy(self, key, phyla_dic, family_dic, group_dic):
+        if phyla_dic is self.phyla_dic:
+            self._genealogy_wo_dialects = None
+        family = self.lang_dic[key]["gen"][0]
+        if self.lang_dic[key]["gen"][1]:
+            group = self.lang_dic[key]["gen"][1]
+        else:
+            group = family + "_ungrouped"
+
+        # Which families contain which groups.
+        if family not in phyla_dic:
+            phyla_dic[family] = set()
+        if group:
+            phyla_dic[family].add(group)
+
+        # Which families and groups contain which langs.
+        if not family in family_dic:
+            family_dic[family] = []
+        family_dic[family].append(key)
+        if not group in group_dic:
+            group_dic[group] = []
+        group_dic[group].append(key)
+
+    def lang_mask(self, with_dialects = True):
+        """Returns the bitset of languages to search."""
+        if with_dialects:
+            return self.all_langs_bits
+        return self.all_langs_bits & ~self.dialect_bits
+
+    def get_langs(self, with_dialects = True):
+        if with_dialects:
+            return self.all_langs
+        return self.all_langs - self.dialects
+
+    def get_genealogy(self, with_dialects = True):
+        """Returns phyla_dic, family_dic, and group_dic, without the dialects
+        unless with_dialects is set. Families and groups having only
+        dialects are left out too."""
+        if with_dialects:
+            return self.phyla_dic, self.family_dic, self.group_dic
+        if self._genealogy_wo_dialects is None:
+            phyla_dic, family_dic, group_dic = {}, {}, {}
+            for key in self.lang_dic:
+                if key in self.inv_dic and key not in self.dialects:
+                    self._add_to_genealogy(key, phyla_dic, family_dic, group_dic)
+            self._genealogy_wo_dialects = (phyla_dic, family_dic, group_dic)
+        return self._genealogy_wo_dialects
+
+    def get_genealogy_bits(self, level = 'family'):
+        """Returns a dict with the bitset of the languages of each family
+        (level = 'family') or group (level = 'group'), dialects included."""
+        if level not in ('family', 'group'):
+            raise Exception("Unknown level %s" % level)
+        if level not in self._genealogy_bits:
+            langs_dic = self.family_dic if level == 'family' else self.group_dic
+            masks = {}
+            for name, langs in langs_dic.items():
+                bits = 0
+                for lang in langs:
+                    bits |= 1 << self.lang_ids[lang]
+                masks[name] = bits
+            self._genealogy_bits[level] = masks
+        return self._genealogy_bits[level]
+
+    def breakdown(self, result, level = 'family', with_dialects = True):
+        """Returns a dict family (or group) -> (count, total, proportion) for
+        the result of a query, given as a bitset or a collection of
+        languages: how many of the languages of the family are in the
+        result, out of how many. Families with no languages to search are
+        left out."""
+        if not isinstance(result, int):
+            result = self._langs2bits(result)
+        universe = self.lang_mask(with_dialects)
+        result &= universe
+        report = {}
+        for name, bits in self.get_genealogy_bits(level).items():
+            total = bin(bits & universe).count('1')
+            if total:
+                count = bin(bits & result).count('1')
+                report[name] = (count, total, count / total)
+        return report
+
+    def _drop_dialects(self, langs, with_dialects):
+        if with_dialects or not self.dialects:
+            return langs
+        return [lang for lang in langs if lang not in self.dialects]
 
     def generate_family_report(self, family):
         """This report, unlike the group one, will include data on group membership of languages in the family to show them on the map."""
-        report = {}
-        langs_to_report = self.family_dic[family]
-        report["map_data"] = [] # List of lists of the type [lang_name, group, lat, lon]
-        for lang in langs_to_report:
-            report["map_data"].append(
-                [id2name(lang),
-                self.lang_dic[lang]["gen"][1],
-                self.lang_dic[lang]["coords"][0],
-                self.lang_dic[lang]["coords"][1]]
-                )
-        report["inv_sizes"] = self.get_inv_sizes(langs_to_report)
-        report["table_of_common_phons"] = self.get_common_table(langs_to_report)
-        return json.dumps(report, indent = 4, ensure_ascii = False)
+        return json.dumps(self.get_report('family', family), indent = 4, ensure_ascii = False)
 
     def generate_group_report(self, group):
-        langs_to_report = self.group_dic[group]
-        report = {} #To return as a JSON object.
-        report["map_data"] = [] # List of lists of the type [lang_name, lat, lon]
-        for lang in langs_to_report:
-            report["map_data"].append(
-                [id2name(lang),
-                self.lang_dic[lang]["coords"][0],
-                self.lang_dic[lang]["coords"][1]]
-                )
-        report["inv_sizes"] = self.get_inv_sizes(langs_to_report)
-        report["table_of_common_phons"] = self.get_common_table(langs_to_report)
-        return json.dumps(report, indent = 4, ensure_ascii = False)
+        return json.dumps(self.get_report('group', group), indent = 4, ensure_ascii = False)
+
+    def get_report(self, kind, name, with_dialects = True):
+        """Returns the data of the report on a family (kind = 'family') or a
+        group (kind = 'group'): a dict with the map data, the inventory
+        sizes, and the table of common phonemes. Reports are built on first
+        access and kept until the database changes, so they must not be
+        modified."""
+        if kind not in ('family', 'group'):
+            raise Exception("Unknown kind of report %s" % kind)
+        key = (kind, name, with_dialects)
+        if key not in self._reports:
+            phyla_dic, family_dic, group_dic = self.get_genealogy(with_dialects)
+            langs_to_report = family_dic[name] if kind == 'family' else group_dic[name]
+            report = {}
+            report["map_data"] = [] # List of lists of the type [lang_name, group, lat, lon] or [lang_name, lat, lon]
+            for lang in langs_to_report:
+                row = [id2name(lang)]
+                if kind == 'family':
+                    row.append(self.lang_dic[lang]["gen"][1])
+                row.extend(self.lang_dic[lang]["coords"][:2])
+                report["map_data"].append(row)
+            report["inv_sizes"] = self.get_inv_sizes(langs_to_report)
+            report["table_of_common_phons"] = self.get_common_table(langs_to_report)
+            self._reports[key] = report
+        return self._reports[key]
 
     def get_common_table(self, langs_to_report):
         common_phonemes = set.intersection(*[self.inv_dic[lang] for lang in langs_to_report])
@@ -180,111 +370,339 @@ class LangSearchEngine:
             report["tones"].append(ntones)
         return report
 
+    def _derived_defaults(self):
+        return {
+            "_incidence": None,    # PhonoStats.IncidenceMatrix.
+            "_similarity": None,   # PhonoSimilarity.MinHashIndex.
+            "_distances": {},      # (kind, family, group, with_dialects) -> (langs, matrix).
+            "_cooccurrences": {},  # (level, family, group, with_dialects) -> PhonoStats.Cooccurrence.
+            "_ratings": {},        # Arguments of feature_rating and IPA_query_rating -> full rating.
+            "_spatial": None,      # PhonoGeo.SpatialIndex.
+            "_reports": {},        # (kind, name, with_dialects) -> data of get_report.
+            "_genealogy_bits": {}  # 'family' or 'group' -> {name: bitset of langs}.
+        }
+
+    def _drop_derived(self):
+        self.__dict__.update(self._derived_defaults())
+
+    def get_incidence(self):
+        """Returns the language × phoneme incidence matrix (needs NumPy)."""
+        if self._incidence is None:
+            import PhonoStats # Not at the top: it imports NumPy, which is slow to load.
+            self._incidence = PhonoStats.IncidenceMatrix(self)
+        return self._incidence
+
+    def _subset(self, family, group, with_dialects):
+        """Languages of a group, a family, or all of them, in the engine's order."""
+        phyla_dic, family_dic, group_dic = self.get_genealogy(with_dialects)
+        if group is not None:
+            return list(group_dic.get(group, []))
+        if family is not None:
+            return list(family_dic.get(family, []))
+        return [lang for lang in self.lang_list if lang in self.inv_dic and (with_dialects or lang not in self.dialects)]
+
+    def get_cooccurrence(self, level = 'phonemes', family = None, group = None, with_dialects = True):
+        """Returns a PhonoStats.Cooccurrence for the phonemes or ('features')
+        the features of the languages of family, group, or the database. It
+        is kept until the engine changes."""
+        key = (level, family, group, with_dialects)
+        if key not in self._cooccurrences:
+            import PhonoStats
+            incidence = self.get_incidence()
+            rows = incidence.row_ids(self._subset(family, group, with_dialects))
+            if level == 'phonemes':
+                self._cooccurrences[key] = PhonoStats.Cooccurrence(incidence.matrix[rows], incidence.glyphs, incidence.phonemes)
+            elif level == 'features':
+                self._cooccurrences[key] = PhonoStats.Cooccurrence(incidence.feature_matrix[rows], incidence.features)
+            else:
+                raise Exception("Unknown level:", level)
+        return self._cooccurrences[key]
+
+    def get_distance_matrix(self, kind = 'jaccard', family = None, group = None, with_dialects = True):
+        """Returns the list of languages and the matrix of distances between
+        their inventories: 'jaccard' on phonemes or 'features' on the numbers
+        of phonemes with each feature (see PhonoStats). The languages are
+        those of family or group if given, and without the dialects if
+        with_dialects is False. Matrices are kept until the engine changes."""
+        key = (kind, family, group, with_dialects)
+        if key not in self._distances:
+            langs = self._subset(family, group, with_dialects)
+            incidence = self.get_incidence()
+            if kind == 'jaccard':
+                matrix = incidence.jaccard_distances(langs)
+            elif kind == 'features':
+                matrix = incidence.feature_distances(langs)
+            else:
+                raise Exception("Unknown kind of distance:", kind)
+            self._distances[key] = (langs, matrix)
+        return self._distances[key]
+
+    def export_distance_matrix(self, path, kind = 'jaccard', family = None, group = None, with_dialects = True):
+        """Writes a distance matrix to path, as CSV if it ends with .csv and
+        as a compressed NumPy .npz file otherwise."""
+        import PhonoStats
+        langs, matrix = self.get_distance_matrix(kind, family, group, with_dialects)
+        if path.endswith('.csv'):
+            PhonoStats.write_distances_csv(path, langs, matrix)
+        else:
+            PhonoStats.save_distances(path, langs, matrix)
+
+    def get_similarity_index(self):
+        """Returns the MinHash index of the inventories."""
+        if self._similarity is None:
+            self._similarity = PhonoSimilarity.MinHashIndex(self)
+        return self._similarity
+
+    def similar_languages(self, query, k = 10, rerank = True, with_dialects = True):
+        """Returns up to k (similarity, lang) pairs for the languages with
+        inventories most similar to query, which is either a language or a
+        list of phonemes in IPA. The language itself is left out."""
+        if isinstance(query, str):
+            keys = self.inv_dic[query]
+            exclude = (query,)
+        else:
+            parsed, errors = IPAParser.parse_inventory(query, IPAParser.QUERY_PARSE_CACHE)
+            if errors:
+                raise Exception("Failed to parse", errors[0].glyph)
+            keys = { phoneme.key for phoneme in parsed }
+            exclude = ()
+        return self.get_similarity_index().query(keys, k, rerank, exclude, with_dialects)
+
+    def get_spatial_index(self):
+        """Returns the grid index over the coordinates of the languages."""
+        if self._spatial is None:
+            self._spatial = PhonoGeo.SpatialIndex(self.coord_dic)
+        return self._spatial
+
+    def _place(self, center):
+        """Coordinates of a language or of a (lat, lon) pair."""
+        if isinstance(center, str):
+            return self.get_spatial_index().coords(center)
+        return float(center[0]), float(center[1])
+
+    def _geo_filter(self, langs, with_dialects):
+        if langs is not None:
+            langs = set(langs)
+            if not with_dialects:
+                langs.difference_update(self.dialects)
+        elif not with_dialects:
+            langs = self.get_langs(with_dialects = False)
+        return langs
+
+    def langs_near(self, center, radius, langs = None, with_dialects = True):
+        """Returns (distance in km, lang) pairs for the languages within
+        radius km of center (a language or a (lat, lon) pair), nearest
+        first. langs restricts the search, e.g. to the result of a query."""
+        lat, lon = self._place(center)
+        return self.get_spatial_index().within(lat, lon, radius, self._geo_filter(langs, with_dialects))
+
+    def nearest_langs(self, center, k = 10, langs = None, with_dialects = True):
+        """Same as langs_near for the k languages nearest to center; a
+        language given as center is left out."""
+        lat, lon = self._place(center)
+        langs = self._geo_filter(langs, with_dialects)
+        if isinstance(center, str):
+            langs = (langs if langs is not None else self.all_langs) - {center}
+        return self.get_spatial_index().nearest(lat, lon, k, langs)
+
+    def langs_in_bbox(self, south, west, north, east, langs = None, with_dialects = True):
+        """Returns the set of languages in a box of latitudes and longitudes;
+        west > east for boxes crossing the 180th meridian."""
+        return self.get_spatial_index().in_bbox(south, west, north, east, self._geo_filter(langs, with_dialects))
+
+    def map_clusters(self, zoom, langs = None, with_dialects = True):
+        """Returns the languages (all or langs) binned into grid cells for a
+        map at a zoom level, with counts by family; see
+        PhonoGeo.SpatialIndex.clusters."""
+        families = { lang: self.lang_dic[lang]["gen"][0] for lang in self.coord_dic }
+        return self.get_spatial_index().clusters(PhonoGeo.zoom_cell_size(zoom), self._geo_filter(langs, with_dialects), families)
+
     def add_language(self, lang_name, phonemes):
+        """Adds the inventory of a language. Only the search structures are
+        updated; see update_language for adding a whole record."""
+        if lang_name in self.inv_dic:
+            self._remove_inventory(lang_name)
+        self.version = next(_VERSIONS)
         self.all_langs.add(lang_name)
         self.inv_dic[lang_name] = set()
+        self._drop_derived()
+        if lang_name not in self.lang_ids:
+            self.lang_ids[lang_name] = len(self.lang_list)
+            self.lang_list.append(lang_name)
+        lang_bit = 1 << self.lang_ids[lang_name]
+        self.all_langs_bits |= lang_bit
         # We do not account for polyphthongs and apical vowels for now -- todo!
-        for phoneme in phonemes:
-            glyph = phoneme
-            phoneme = set.union(*IPAParser.parsePhon(phoneme))
-            phoneme_key = frozenset(phoneme)
+        parsed, errors = IPAParser.parse_inventory(phonemes)
+        if errors:
+            self.parse_errors[lang_name] = errors
+        for phoneme in parsed:
+            glyph = phoneme.glyph
+            phoneme = phoneme_key = phoneme.key
+            if phoneme_key in self.inv_dic[lang_name]:
+                continue
             self.inv_dic[lang_name].add(phoneme_key)
-            if phoneme_key not in self.all_phonemes:
-                self.all_phonemes[phoneme_key] = glyph
-            if 'vowel' in phoneme:
-                if phoneme.intersection({'apical', 'diphthong', 'triphthong'}):
-                    if phoneme_key not in self.non_systematic:
-                        self.non_systematic[phoneme_key] = [glyph, []]
-                    self.non_systematic[phoneme_key][1].append(lang_name)
-                    continue
-                height = phoneme.intersection(VOW_ROW_NAMES).pop()
-                y_coord = self.vow_y_coords[height]
-                row = phoneme.intersection(VOW_COL_NAMES).pop()
-                x_coord = self.vow_x_coords[row]
-                if phoneme_key not in self.vow_table[y_coord][x_coord]:
-                    self.vow_table[y_coord][x_coord][phoneme_key] = (glyph, [])
-                self.vow_table[y_coord][x_coord][phoneme_key][1].append(lang_name)
+            self.phoneme_bits[phoneme_key] = self.phoneme_bits.get(phoneme_key, 0) | lang_bit
+            self._forget_feature_counts(phoneme_key)
+            for feature in phoneme_key:
+                counts = self.feature_counts.setdefault(feature, {})
+                counts[lang_name] = counts.get(lang_name, 0) + 1
+            # The same list of langs is shared by every structure below.
+            if phoneme_key in self.phoneme_index:
+                self.phoneme_index[phoneme_key].append(lang_name)
+                continue
+            langs = self.phoneme_index[phoneme_key] = [lang_name]
+            self.all_phonemes[phoneme_key] = glyph
+            for feature in phoneme_key:
+                if feature not in self.feature_index:
+                    self.feature_index[feature] = set()
+                self.feature_index[feature].add(phoneme_key)
+            if self.encoder is not None:
+                self.mask_dic[self.encoder.encode(phoneme_key)] = [glyph, langs]
+            # The cell is remembered: _phoneme_cell may choose another one
+            # for the same phoneme under another hash seed, e.g. after
+            # loading a snapshot made by another process.
+            cell = self.phoneme_cells[phoneme_key] = self._phoneme_cell(phoneme_key)
+            if cell is self.non_systematic:
+                cell[phoneme_key] = [glyph, langs]
             else:
-                try:
-                    manner = phoneme.intersection(CONS_ROW_NAMES).pop()
-                except KeyError:
-                    raise Exception("A consonant does not have a manner:", phoneme)
-                y_coord = self.cons_y_coords[manner]
-                place = phoneme.intersection(CONS_COL_NAMES).pop()
-                x_coord = self.cons_x_coords[place]
-                if phoneme_key not in self.cons_table[y_coord][x_coord]:
-                    self.cons_table[y_coord][x_coord][phoneme_key] = (glyph, [])
-                self.cons_table[y_coord][x_coord][phoneme_key][1].append(lang_name)
-
-    def IPA_exact_query(self, phoneme_string):
-        """Returns a list of languages containing this phoneme."""
+                cell[phoneme_key] = (glyph, langs)
 
-        phoneme = set.union(*IPAParser.parsePhon(phoneme_string))
-        result = {}
+    def _phoneme_cell(self, phoneme):
+        """Returns the dict where the phoneme is kept: a cell of the vowel or
+        consonant table or non_systematic."""
         if 'vowel' in phoneme:
             if phoneme.intersection({'apical', 'diphthong', 'triphthong'}):
-                phoneme_key = frozenset(phoneme)
-                if phoneme_key in self.non_systematic:
-                    return self.non_systematic[phoneme_key][1]
-                else:
-                    return []
-            height = phoneme.intersection(self.vow_rows).pop()
+                return self.non_systematic
+            height = self.vow_rows.intersection(phoneme).pop()
             y_coord = self.vow_y_coords[height]
-            row = phoneme.intersection(self.vow_cols).pop()
+            row = self.vow_cols.intersection(phoneme).pop()
             x_coord = self.vow_x_coords[row]
-            for key in self.vow_table[y_coord][x_coord]:
-                if key == phoneme:
-                    return self.vow_table[y_coord][x_coord][key][1]
-            return []         
+            return self.vow_table[y_coord][x_coord]
         else:
-            manner = phoneme.intersection(self.cons_rows).pop()
+            try:
+                manner = self.cons_rows.intersection(phoneme).pop()
+            except KeyError:
+                raise Exception("A consonant does not have a manner:", phoneme)
             y_coord = self.cons_y_coords[manner]
-            place = phoneme.intersection(self.cons_cols).pop()
+            place = self.cons_cols.intersection(phoneme).pop()
             x_coord = self.cons_x_coords[place]
-            for key in self.cons_table[y_coord][x_coord]:
-                if key == phoneme:
-                    return self.cons_table[y_coord][x_coord][key][1]
-            return []
-        raise Exception("Unreachable!")
+            return self.cons_table[y_coord][x_coord]
+
+    def _forget_feature_counts(self, phoneme_key):
+        for feature in phoneme_key:
+            self._feature_lang_counts.pop(feature, None)
+
+    def remove_language(self, lang_name):
+        """Removes a language from the engine, with its record if there is
+        one. Only the phonemes of the language are touched. The language
+        keeps its bit number, so adding it again reuses it."""
+        if lang_name not in self.inv_dic:
+            raise Exception("No such language:", lang_name)
+        self.source_hash = None # The snapshot no longer matches the file.
+        self._remove_inventory(lang_name)
+        lang_bit = 1 << self.lang_ids[lang_name]
+        if lang_name in self.dialects:
+            self.dialects.discard(lang_name)
+            self.dialect_bits &= ~lang_bit
+        self.coord_dic.pop(lang_name, None)
+        self.family_group_dic.pop(lang_name, None)
+        if lang_name in self.lang_dic:
+            self._remove_from_genealogy(lang_name)
+            del self.lang_dic[lang_name]
+
+    def _remove_inventory(self, lang_name):
+        self.version = next(_VERSIONS)
+        self._drop_derived()
+        lang_bit = 1 << self.lang_ids[lang_name]
+        self.all_langs.discard(lang_name)
+        self.all_langs_bits &= ~lang_bit
+        self.parse_errors.pop(lang_name, None)
+        for phoneme_key in self.inv_dic.pop(lang_name):
+            self._forget_feature_counts(phoneme_key)
+            self.phoneme_bits[phoneme_key] &= ~lang_bit
+            for feature in phoneme_key:
+                counts = self.feature_counts[feature]
+                counts[lang_name] -= 1
+                if not counts[lang_name]:
+                    del counts[lang_name]
+                    if not counts:
+                        del self.feature_counts[feature]
+            langs = self.phoneme_index[phoneme_key]
+            langs.remove(lang_name) # Shared with the tables and mask_dic.
+            if langs:
+                continue
+            # The last language with this phoneme.
+            del self.phoneme_index[phoneme_key]
+            del self.phoneme_bits[phoneme_key]
+            del self.all_phonemes[phoneme_key]
+            for feature in phoneme_key:
+                self.feature_index[feature].discard(phoneme_key)
+                if not self.feature_index[feature]:
+                    del self.feature_index[feature]
+            if self.encoder is not None:
+                del self.mask_dic[self.encoder.encode(phoneme_key)]
+            del self.phoneme_cells.pop(phoneme_key)[phoneme_key]
+
+    def _remove_from_genealogy(self, key):
+        self._genealogy_wo_dialects = None
+        family = self.lang_dic[key]["gen"][0]
+        group = self.lang_dic[key]["gen"][1] or family + "_ungrouped"
+        if key in self.family_dic.get(family, ()):
+            self.family_dic[family].remove(key)
+            if not self.family_dic[family]:
+                del self.family_dic[family]
+                del self.phyla_dic[family]
+        if key in self.group_dic.get(group, ()):
+            self.group_dic[group].remove(key)
+            if not self.group_dic[group]:
+                del self.group_dic[group]
+                if family in self.phyla_dic:
+                    self.phyla_dic[family].discard(group)
 
-    def IPA_query(self, phoneme_string):
+    def update_language(self, lang_name, record):
+        """Adds a language with a record in the format of the database, or
+        replaces the one already there. Dialects are left out of engines
+        built without them."""
+        if lang_name in self.inv_dic:
+            self.remove_language(lang_name)
+        if record["type"] == "Диалект" and not self.with_dialects:
+            return
+        self.source_hash = None
+        self.lang_dic[lang_name] = record
+        self._add_record(lang_name)
+
+    def IPA_exact_query(self, phoneme_string, with_dialects = True):
+        """Returns a list of languages containing this phoneme."""
+
+        phoneme = IPAParser.QUERY_PARSE_CACHE.key(phoneme_string)
+        return self._drop_dialects(self.phoneme_index.get(phoneme, []), with_dialects)
+
+    def IPA_query(self, phoneme_string, with_dialects = True):
         """Returns a dictionary with languages containing this phoneme and its derivatives."""
 
-        phoneme = set.union(*IPAParser.parsePhon(phoneme_string))
+        phoneme = IPAParser.QUERY_PARSE_CACHE.key(phoneme_string)
         result = {}
-        if 'vowel' in phoneme:
-            if phoneme.intersection({'apical', 'diphthong', 'triphthong'}):
-                for key in self.non_systematic:
-                    if key.issuperset(phoneme):
-                        glyph = self.non_systematic[key][0]
-                        langs = self.non_systematic[key][1]
-                        result[glyph] = langs
-                return result
-            height = phoneme.intersection(self.vow_rows).pop()
-            y_coord = self.vow_y_coords[height]
-            row = phoneme.intersection(self.vow_cols).pop()
-            x_coord = self.vow_x_coords[row]
-            for key in self.vow_table[y_coord][x_coord]:
-                if key.issuperset(phoneme):
-                    glyph = self.vow_table[y_coord][x_coord][key][0]
-                    langs = self.vow_table[y_coord][x_coord][key][1]
-                    result[glyph] = langs
-            return result
-        else:
-            manner = phoneme.intersection(self.cons_rows).pop()
-            y_coord = self.cons_y_coords[manner]
-            place = phoneme.intersection(self.cons_cols).pop()
-            x_coord = self.cons_x_coords[place]
-            for key in self.cons_table[y_coord][x_coord]:
-                if key.issuperset(phoneme):
-                    glyph = self.cons_table[y_coord][x_coord][key][0]
-                    langs = self.cons_table[y_coord][x_coord][key][1]
-                    result[glyph] = langs
-            return result
-        raise Exception("Unreachable!")
+        for key in self._superset_keys(phoneme):
+            langs = self._drop_dialects(self.phoneme_index[key], with_dialects)
+            if langs:
+                result[self.all_phonemes[key]] = langs
+        return result
+
+    def _superset_keys(self, features):
+        """Returns the set of phoneme keys having all the features."""
+        if not features:
+            return set(self.phoneme_index)
+        postings = sorted((self.feature_index.get(feature, ()) for feature in features), key = len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def IPA_query_multiple(self, *args, exact = False, explain = False, by = None, with_dialects = True):
+        """Returns the set of languages having all the phonemes in args and
+        lacking those preceded by '-'. With exact set, phonemes are looked up
+        as they are; otherwise their derivatives count too. With explain set,
+        returns the result together with the plan, as run by _run_plan. With
+        by set to 'family' or 'group', returns the counts by family or group
+        instead of the languages, as from breakdown."""
 
-    def IPA_query_multiple(self, *args):
-        result = set()
         positive = []
         negative = []
         for phoneme in args:
@@ -294,79 +712,295 @@ class LangSearchEngine:
                 positive.append(phoneme)
         if not negative and not positive:
             raise Exception("Nothing to search for")
-        if not positive:
-            result = self.all_langs
+        if exact:
+            lookup   = self._exact_bits
+            estimate = self._exact_estimate
+        else:
+            lookup   = self._superset_bits
+            estimate = self._superset_estimate
+        return self._run_plan(positive, negative, lookup, estimate, explain, by, with_dialects)
+
+    def _run_plan(self, positive, negative, lookup, estimate, explain = False, by = None, with_dialects = True):
+        """Intersects the bitsets of positive terms, rarest first, and then
+        subtracts those of negative terms. Stops as soon as nothing is left.
+        The plan is a list of dicts with the term, its estimated size, the
+        number of languages left after it and the time taken; terms which
+        were not evaluated are not in it."""
+        positive = sorted(set(positive), key = estimate)
+        result = self.lang_mask(with_dialects)
+        plan = []
+        for negated, terms in ((False, positive), (True, negative)):
+            for term in terms:
+                if not result:
+                    break
+                start = time.perf_counter()
+                if negated:
+                    result &= ~lookup(term)
+                else:
+                    result &= lookup(term)
+                if explain:
+                    plan.append({
+                        "term": '-' + term if negated else term,
+                        "estimate": None if negated else estimate(term),
+                        "left": bin(result).count('1'),
+                        "time": time.perf_counter() - start
+                    })
+        if by is not None:
+            result = self.breakdown(result, by, with_dialects)
         else:
-            result = self._dict2set(self.IPA_query(positive[0]))
-            for phoneme in positive[1:]:
-                result = result.intersection(self._dict2set(self.IPA_query(phoneme)))
-        for phoneme in negative:
-            result = result.difference(self._dict2set(self.IPA_query(phoneme)))
+            result = self._bits2langs(result)
+        if explain:
+            return result, plan
         return result
 
-    def inject_laterals(self, arg):
-        pass
+    def _exact_estimate(self, phoneme_string):
+        """Number of languages having the phoneme."""
+        key = IPAParser.QUERY_PARSE_CACHE.key(phoneme_string)
+        return len(self.phoneme_index.get(key, ()))
+
+    def _superset_estimate(self, phoneme_string):
+        return self._features_estimate(IPAParser.QUERY_PARSE_CACHE.key(phoneme_string))
+
+    def _features_estimate(self, features):
+        """Upper bound on the number of languages having a phoneme with all
+        the features: the smallest number of languages having one of them."""
+        if not features:
+            return len(self.inv_dic)
+        counts = self._feature_lang_counts
+        for feature in features:
+            if feature not in counts:
+                counts[feature] = bin(self._keys2bits(self.feature_index.get(feature, ()))).count('1')
+        return min(counts[feature] for feature in features)
+
+    def _exact_bits(self, phoneme_string):
+        return self.phoneme_bits.get(IPAParser.QUERY_PARSE_CACHE.key(phoneme_string), 0)
+
+    def _superset_bits(self, phoneme_string):
+        return self._keys2bits(self._superset_keys(IPAParser.QUERY_PARSE_CACHE.key(phoneme_string)))
+
+    def _keys2bits(self, keys):
+        result = 0
+        for key in keys:
+            result |= self.phoneme_bits[key]
+        return result
+
+    def _langs2bits(self, langs):
+        lang_ids = self.lang_ids
+        result = 0
+        for lang in langs:
+            result |= 1 << lang_ids[lang]
+        return result
+
+    def _bits2langs(self, bits):
+        lang_list = self.lang_list
+        return { lang_list[i] for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1' }
+
+    def _query_mask(self, features):
+        if self.encoder is None:
+            raise Exception("The engine was built without feature masks")
+        return self.encoder.encode(features, grow = False)
+
+    def IPA_exact_mask_query(self, phoneme_string, with_dialects = True):
+        """Same as IPA_exact_query, but looks the phoneme up by its bitmask."""
+
+        mask = self._query_mask(IPAParser.QUERY_PARSE_CACHE.key(phoneme_string))
+        if mask in self.mask_dic:
+            return self._drop_dialects(self.mask_dic[mask][1], with_dialects)
+        return []
+
+    def IPA_mask_query(self, phoneme_string, with_dialects = True):
+        """Same as IPA_query, but tests bitmasks of all phonemes instead of the
+        frozensets in one table cell."""
+
+        query = self._query_mask(IPAParser.QUERY_PARSE_CACHE.key(phoneme_string))
+        result = {}
+        if query is None:
+            return result
+        for mask, (glyph, langs) in self.mask_dic.items():
+            if mask & query == query:
+                langs = self._drop_dialects(langs, with_dialects)
+                if langs:
+                    result[glyph] = langs
+        return result
+
+    def _feature_mask_langs(self, feature):
+        query = self._query_mask(feature.split())
+        result = set()
+        if query is None:
+            return result
+        for mask, (glyph, langs) in self.mask_dic.items():
+            if mask & query == query:
+                result.update(langs)
+        return result
+
+    def features_mask_query(self, *args, with_dialects = True):
+        """Same as features_query, but with bitmasks."""
 
-    def features_query(self, *args):
         positive = set()
         negative = set()
-        all_positives = []
-        for arg in args:
-            if 'lateral affricate' in arg:
-                arg = arg.replace('lateral affricate', 'lateral_affricate')
-            if 'lateral fricative' in arg:
-                arg = arg.replace('lateral fricative', 'lateral_fricative')
-            if 'lateral approximant' in arg:
-                arg = arg.replace('lateral approximant', 'lateral_approximant')
         for arg in args:
             if arg[0] == '-':
                 negative.add(arg[1:])
             else:
                 positive.add(arg)
         if not positive:
-            result = self.all_langs
+            result = set(self.get_langs(with_dialects))
         else:
-            for feature in positive:
-                feature = set(feature.split())
-                temp = set()
-                for key in self.all_phonemes:
-                    if feature.issubset(key):
-                        temp.update(self._dict2set(self.IPA_query(self.all_phonemes[key])))
-                all_positives.append(temp)
-            result = set.intersection(*all_positives)
+            result = set.intersection(*[self._feature_mask_langs(feature) for feature in positive])
         for feature in negative:
-            feature = set(feature.split())
-            for key in self.all_phonemes:
-                if feature.issubset(key):
-                    result = result.difference(self._dict2set(self.IPA_query(self.all_phonemes[key])))
+            result.difference_update(self._feature_mask_langs(feature))
+        if not with_dialects:
+            result.difference_update(self.dialects)
         return result
 
+    def inject_laterals(self, arg):
+        pass
+
+    def _feature_bits(self, feature):
+        """Returns the bitset of languages having a phoneme with all the features
+        in a space-separated string."""
+        return self._keys2bits(self._superset_keys(feature.split()))
+
+    def features_query(self, *args, explain = False, by = None, with_dialects = True):
+        positive = set()
+        negative = set()
+        for arg in args:
+            if arg[0] == '-':
+                negative.add(arg[1:])
+            else:
+                positive.add(arg)
+        estimate = lambda feature: self._features_estimate(feature.split())
+        return self._run_plan(positive, negative, self._feature_bits, estimate, explain, by, with_dialects)
+
+    def boolean_query(self, query, with_dialects = True, by = None):
+        """Returns the set of languages matching a query in the language of
+        PhonoQuery, given as a string or as a plan from parse_query, or the
+        counts by family or group if by is set, as from breakdown."""
+        if isinstance(query, str):
+            query = PhonoQuery.parse_query(query)
+        if by is not None:
+            return self.breakdown(PhonoQuery.evaluate_bits(self, query, with_dialects), by, with_dialects)
+        return PhonoQuery.evaluate(self, query, with_dialects)
+
     def feature_query_stat(self):
         pass
 
-    def _dict2set(self, dic):
-        result = set()
-        for key in dic:
-            for lang in dic[key]:
-                result.add(lang)
+    def _top(self, key, k, make_items):
+        """Returns the k largest of the items from make_items (all of them if
+        k is None), largest first. A full ranking is sorted once and kept
+        until the engine changes; a top k is picked with a heap unless the
+        full ranking is already there."""
+        if key in self._ratings:
+            return self._ratings[key][:k]
+        if k is not None:
+            return heapq.nlargest(k, make_items())
+        self._ratings[key] = sorted(make_items(), reverse = True)
+        return self._ratings[key][:]
+
+    def feature_rating(self, feature, k = None, family = None, group = None, with_dialects = True):
+        """Returns (number of phonemes, lang) pairs for the languages with the
+        most phonemes having the feature (or all the features in a
+        space-separated string), most first; languages without any are left
+        out. With k set only the top k are returned."""
+        def make_items():
+            features = feature.split()
+            if len(features) == 1:
+                counts = self.feature_counts.get(feature, {})
+            else:
+                counts = {}
+                for key in self._superset_keys(features):
+                    for lang in self.phoneme_index[key]:
+                        counts[lang] = counts.get(lang, 0) + 1
+            langs = self._subset(family, group, with_dialects)
+            return ((counts[lang], lang) for lang in langs if lang in counts)
+        return self._top(('feature', feature, family, group, with_dialects), k, make_items)
+
+    def IPA_query_rating(self, k = None, family = None, group = None, with_dialects = True):
+        """Returns (number of languages, phoneme) pairs for the most common
+        phonemes in the database, a family, or a group, most common first.
+        With k set only the top k are returned."""
+        def make_items():
+            mask = 0
+            for lang in self._subset(family, group, with_dialects):
+                mask |= 1 << self.lang_ids[lang]
+            counts = ((bin(bits & mask).count('1'), self.all_phonemes[key]) for key, bits in self.phoneme_bits.items())
+            return (item for item in counts if item[0])
+        return self._top(('phoneme', family, group, with_dialects), k, make_items)
+
+class QueryCache:
+    """LRU cache for query results. Keys should come from canonical_phonemes
+    and canonical_features, so that equivalent queries share an entry.
+    Results are stored as they are and must not be modified by callers."""
+    def __init__(self, maxsize = 1024):
+        self.maxsize   = maxsize
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._entries  = OrderedDict()
+        self._lock     = threading.Lock()
+
+    def get(self, key, compute):
+        """Returns the cached result for key, calling compute() on a miss.
+        Exceptions from compute() are not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        result = compute()
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+                self.evictions += 1
         return result
 
-    def feature_rating(self, feature):
-        feature_havers = {}
-        for lang in self.features_query(feature):
-            counter = 0
-            for phon in engine.lang_dic[lang]:
-                if feature in set.union(*IPAParser.parsePhon(phon)):
-                    counter += 1
-            feature_havers[lang] = counter
-        rating = []
-        for key, value in feature_havers.items():
-            rating.append((value, key))
-        rating.sort(reverse = True)
-        return rating
-
-    def IPA_query_rating(self):
-        pass # todo
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio(),
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+def _split_negation(term):
+    term = term.strip()
+    if term.startswith('-'):
+        return True, term[1:]
+    return False, term
+
+def canonical_phonemes(*args):
+    """Returns a hashable key for a list of phoneme terms as taken by
+    IPA_query_multiple: order, surrounding whitespace, duplicates, and
+    different spellings of the same phoneme do not matter. Raises on
+    glyphs which cannot be parsed."""
+    result = set()
+    for term in args:
+        negative, glyph = _split_negation(term)
+        result.add((negative, IPAParser.QUERY_PARSE_CACHE.key(glyph)))
+    return frozenset(result)
+
+def canonical_features(*args):
+    """Same as canonical_phonemes for the terms of features_query; the
+    words of a composite feature can come in any order."""
+    result = set()
+    for term in args:
+        negative, feature = _split_negation(term)
+        result.add((negative, frozenset(feature.split())))
+    return frozenset(result)
 
 def clear(s):
     return s.strip(' \n\t').replace('\u0361', '').replace('\u2009', '')
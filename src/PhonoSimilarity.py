@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Search for languages with similar inventories.
+
+Every inventory gets a MinHash signature: for each of num_perm hash
+functions, the smallest hash of its phonemes. Two signatures agree in a
+given position with probability equal to the Jaccard similarity of the
+inventories. Signatures are cut into bands, and languages whose
+signatures coincide in at least one band are candidates (locality-
+sensitive hashing), so a query only looks at a few buckets instead of all
+the inventories."""
+
+import heapq
+import random
+import hashlib
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 61) - 1
+
+def phoneme_hash(key):
+    """A hash of a phoneme's features which does not depend on the process
+    (unlike hash() of strings)."""
+    digest = hashlib.blake2b(' '.join(sorted(key)).encode('utf-8'), digest_size = 8).digest()
+    return int.from_bytes(digest, 'big')
+
+def jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+class MinHashIndex:
+    """MinHash signatures of all inventories of a LangSearchEngine with an
+    LSH index over them. With bands bands of num_perm // bands rows each,
+    pairs with a Jaccard similarity above about (1 / bands) ** (bands /
+    num_perm) are likely to be found. The defaults put this at 0.3: the
+    inventories in the database are not that close to each other, and with
+    them 88% of the true ten nearest neighbours are found."""
+    def __init__(self, engine, num_perm = 96, bands = 32, seed = 1):
+        if num_perm % bands:
+            raise Exception("num_perm must be a multiple of bands")
+        self.engine   = engine
+        self.num_perm = num_perm
+        self.bands    = bands
+        self.rows     = num_perm // bands
+        generator = random.Random(seed)
+        self.coefficients = [(generator.randrange(1, _PRIME), generator.randrange(0, _PRIME)) for i in range(num_perm)]
+        self._phoneme_hashes = {} # Phoneme -> its num_perm hashes.
+        self.signatures = {} # Lang -> signature.
+        self.buckets = [{} for i in range(bands)] # Band -> {band of a signature: set of langs}.
+        for lang, inventory in engine.inv_dic.items():
+            signature = self.signature(inventory)
+            self.signatures[lang] = signature
+            for band, chunk in enumerate(self._bands(signature)):
+                self.buckets[band].setdefault(chunk, set()).add(lang)
+
+    def _hashes(self, key):
+        if key not in self._phoneme_hashes:
+            value = phoneme_hash(key)
+            self._phoneme_hashes[key] = tuple((a * value + b) % _PRIME for a, b in self.coefficients)
+        return self._phoneme_hashes[key]
+
+    def signature(self, keys):
+        """Returns the signature of a set of phoneme keys."""
+        if not keys:
+            return (_MAX_HASH,) * self.num_perm
+        return tuple(map(min, zip(*[self._hashes(key) for key in keys])))
+
+    def _bands(self, signature):
+        rows = self.rows
+        return [signature[i : i + rows] for i in range(0, self.num_perm, rows)]
+
+    def candidates(self, signature):
+        """Returns the set of languages sharing a band with signature."""
+        result = set()
+        for band, chunk in enumerate(self._bands(signature)):
+            result.update(self.buckets[band].get(chunk, ()))
+        return result
+
+    def estimate(self, first, second):
+        """Estimated Jaccard similarity of two signatures."""
+        return sum(1 for x, y in zip(first, second) if x == y) / self.num_perm
+
+    def query(self, keys, k = 10, rerank = True, exclude = (), with_dialects = True):
+        """Returns up to k (similarity, lang) pairs for the languages most
+        similar to the set of phoneme keys, best first. With rerank set the
+        candidates are ranked by their exact Jaccard similarity; otherwise by
+        the estimate from the signatures."""
+        signature = self.signature(keys)
+        candidates = self.candidates(signature).difference(exclude)
+        if not with_dialects:
+            candidates.difference_update(self.engine.dialects)
+        if rerank:
+            inv_dic = self.engine.inv_dic
+            scored = ((jaccard(keys, inv_dic[lang]), lang) for lang in candidates)
+        else:
+            scored = ((self.estimate(signature, self.signatures[lang]), lang) for lang in candidates)
+        return heapq.nlargest(k, scored)
@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Whole-database statistics over the inventories of a LangSearchEngine.
+Needs NumPy; the rest of the site works without it."""
+
+import csv
+import IPAParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _count_product(a, b):
+    """Matrix product of two 0/1 matrices as an integer count matrix. NumPy
+    has no BLAS for integers, so this goes through float64, which is exact
+    for any count we can have."""
+    return (a.astype(np.float64) @ b.astype(np.float64)).astype(np.int64)
+
+class IncidenceMatrix:
+    """Languages × phonemes and languages × features incidence matrices.
+
+    Rows follow engine.lang_list, so row numbers are the bit numbers of the
+    engine's language bitsets; rows of languages that are no longer in the
+    engine are left empty and masked out by self.present. Columns follow
+    self.phonemes and self.features."""
+    def __init__(self, engine):
+        if np is None:
+            raise ImportError("The incidence matrix needs NumPy")
+        self.langs    = list(engine.lang_list)
+        self.rows     = { lang: i for i, lang in enumerate(self.langs) }
+        self.phonemes = list(engine.phoneme_index)
+        self.glyphs   = [engine.all_phonemes[key] for key in self.phonemes]
+        self.columns  = { key: j for j, key in enumerate(self.phonemes) }
+        self.features = sorted(engine.feature_index)
+        self.feature_columns = { feature: j for j, feature in enumerate(self.features) }
+
+        row_ids = []
+        col_ids = []
+        for lang, inventory in engine.inv_dic.items():
+            i = self.rows[lang]
+            for key in inventory:
+                row_ids.append(i)
+                col_ids.append(self.columns[key])
+        self.matrix = np.zeros((len(self.langs), len(self.phonemes)), dtype = np.uint8)
+        self.matrix[row_ids, col_ids] = 1
+        self.present = np.zeros(len(self.langs), dtype = bool)
+        self.present[[self.rows[lang] for lang in engine.inv_dic]] = True
+
+        # Phonemes × features, and from it the number of phonemes carrying
+        # each feature in each language.
+        self.phoneme_features = np.zeros((len(self.phonemes), len(self.features)), dtype = np.uint8)
+        for key, j in self.columns.items():
+            self.phoneme_features[j, [self.feature_columns[feature] for feature in key]] = 1
+        self.feature_counts = _count_product(self.matrix, self.phoneme_features)
+        self.feature_matrix = (self.feature_counts > 0).astype(np.uint8)
+
+    def row_ids(self, langs = None):
+        """Row numbers of langs, or of all present languages."""
+        if langs is None:
+            return np.flatnonzero(self.present)
+        return np.array([self.rows[lang] for lang in langs], dtype = np.intp)
+
+    def phoneme_counts(self, langs = None):
+        """Number of languages having each phoneme."""
+        return self.matrix[self.row_ids(langs)].sum(axis = 0, dtype = np.int64)
+
+    def phoneme_frequencies(self, langs = None):
+        rows = self.row_ids(langs)
+        if not len(rows):
+            return np.zeros(len(self.phonemes))
+        return self.matrix[rows].sum(axis = 0, dtype = np.int64) / len(rows)
+
+    def feature_lang_counts(self, langs = None):
+        """Number of languages having at least one phoneme with each feature."""
+        return self.feature_matrix[self.row_ids(langs)].sum(axis = 0, dtype = np.int64)
+
+    def inventory_sizes(self, langs = None):
+        """Returns a dict of arrays with the numbers of all segments,
+        consonants, and vowels in each of langs."""
+        rows = self.row_ids(langs)
+        counts = self.feature_counts[rows]
+        return {
+            "all": self.matrix[rows].sum(axis = 1, dtype = np.int64),
+            "cons": counts[:, self.feature_columns["consonant"]] if "consonant" in self.feature_columns else np.zeros(len(rows), dtype = np.int64),
+            "vows": counts[:, self.feature_columns["vowel"]] if "vowel" in self.feature_columns else np.zeros(len(rows), dtype = np.int64)
+        }
+
+    def aggregate(self, groups, matrix = None):
+        """Sums rows of matrix (self.matrix by default) per group, where groups
+        is a dict like engine.family_dic. Returns the list of group names and
+        an array with a row per group."""
+        if matrix is None:
+            matrix = self.matrix
+        names = list(groups)
+        membership = np.zeros((len(names), len(self.langs)), dtype = np.uint8)
+        for g, name in enumerate(names):
+            membership[g, self.row_ids(groups[name])] = 1
+        return names, _count_product(membership, matrix)
+
+    def aggregate_frequencies(self, groups, matrix = None):
+        """Same as aggregate, but divides by group sizes."""
+        names, sums = self.aggregate(groups, matrix)
+        sizes = np.array([len(groups[name]) for name in names], dtype = np.float64)
+        return names, sums / np.maximum(sizes, 1)[:, None]
+
+    def jaccard_distances(self, langs = None):
+        """Jaccard distances between the inventories of langs (all present
+        languages by default)."""
+        matrix = self.matrix[self.row_ids(langs)]
+        intersections = _count_product(matrix, matrix.T)
+        sizes = np.diagonal(intersections)
+        unions = sizes[:, None] + sizes[None, :] - intersections
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            result = 1.0 - intersections / unions
+        result[unions == 0] = 0.0 # Two empty inventories.
+        return result
+
+    def feature_distances(self, langs = None, block = 64):
+        """Weighted Jaccard (Ruzicka) distances between the feature profiles
+        of langs, i.e. the numbers of phonemes with each feature: one minus
+        the sum of the elementwise minima over the sum of the maxima. Rows
+        are done in blocks to bound the memory used."""
+        # Counts are small, and narrow integers make the minima faster.
+        counts = self.feature_counts[self.row_ids(langs)].astype(np.int16)
+        totals = counts.sum(axis = 1, dtype = np.int64)
+        result = np.empty((len(counts), len(counts)))
+        for start in range(0, len(counts), block):
+            chunk = counts[start : start + block, None, :]
+            minima = np.minimum(chunk, counts[None, :, :]).sum(axis = 2, dtype = np.int64)
+            # max(a, b) = a + b - min(a, b)
+            maxima = totals[start : start + block, None] + totals[None, :] - minima
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                result[start : start + block] = 1.0 - minima / maxima
+            result[start : start + block][maxima == 0] = 0.0
+        return result
+
+def save_distances(path, langs, matrix):
+    """Saves a distance matrix with its row names as a compressed .npz
+    file, with the distances as float32."""
+    np.savez_compressed(path, langs = np.array(langs), distances = matrix.astype(np.float32))
+
+def load_distances(path):
+    """Returns the languages and the matrix saved by save_distances."""
+    with np.load(path) as data:
+        return list(data["langs"]), data["distances"]
+
+def write_distances_csv(path, langs, matrix):
+    with open(path, 'w', encoding = 'utf-8', newline = '') as out:
+        writer = csv.writer(out)
+        writer.writerow([''] + list(langs))
+        for lang, row in zip(langs, matrix):
+            writer.writerow([lang] + ['%.6g' % value for value in row])
+
+class Cooccurrence:
+    """Pairwise statistics over the columns of a languages × items 0/1
+    matrix: how many languages have both items, how often one comes with
+    the other, and how many languages are exceptions to 'a implies b'.
+    Items are looked up by their names; with keys given (the phonemes'
+    feature sets), also by keys and by any spelling of a phoneme."""
+    def __init__(self, matrix, names, keys = None):
+        self.names  = list(names)
+        self.index  = { name: i for i, name in enumerate(self.names) }
+        if keys is not None:
+            self.index.update((key, i) for i, key in enumerate(keys))
+        self.nlangs = matrix.shape[0]
+        self.counts = _count_product(matrix.T, matrix) # Languages having both.
+        self.totals = np.diagonal(self.counts).copy() # Languages having each.
+        self._parse = keys is not None
+
+    def column(self, item):
+        if item in self.index:
+            return self.index[item]
+        if self._parse and isinstance(item, str):
+            key = IPAParser.QUERY_PARSE_CACHE.key(item)
+            if key in self.index:
+                return self.index[key]
+        raise Exception("Not found:", item)
+
+    def count(self, a, b):
+        """Number of languages having both a and b."""
+        return int(self.counts[self.column(a), self.column(b)])
+
+    def conditional(self, a, b):
+        """Proportion of languages with a that also have b."""
+        i = self.column(a)
+        if not self.totals[i]:
+            return 0.0
+        return self.counts[i, self.column(b)] / self.totals[i]
+
+    def exceptions(self, a, b):
+        """Number of languages having a without b."""
+        i = self.column(a)
+        return int(self.totals[i] - self.counts[i, self.column(b)])
+
+    def conditional_matrix(self):
+        """Row a, column b: the proportion of languages with a having b."""
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            result = self.counts / self.totals[:, None]
+        result[self.totals == 0] = 0.0
+        return result
+
+    def implications(self, min_support = 5, max_exceptions = 0, consequent = None, antecedent = None):
+        """Returns (a, b, support, exceptions) for all pairs where a is found
+        in at least min_support languages and at most max_exceptions of
+        them lack b, i.e. 'a implies b' nearly always holds; optionally only
+        those with the given consequent b or antecedent a. Sorted by the
+        number of exceptions, then by support, largest first."""
+        exceptions = self.totals[:, None] - self.counts
+        mask = (self.totals[:, None] >= min_support) & (exceptions <= max_exceptions)
+        np.fill_diagonal(mask, False)
+        if consequent is not None:
+            column = self.column(consequent)
+            keep = np.zeros_like(mask)
+            keep[:, column] = True
+            mask &= keep
+        if antecedent is not None:
+            row = self.column(antecedent)
+            keep = np.zeros_like(mask)
+            keep[row, :] = True
+            mask &= keep
+        result = []
+        for i, j in zip(*np.nonzero(mask)):
+            result.append((self.names[i], self.names[j], int(self.totals[i]), int(exceptions[i, j])))
+        result.sort(key = lambda item: (item[3], -item[2], item[0], item[1]))
+        return result
@@ -1,9 +1,17 @@
-from PhonoSearchLib import LangSearchEngine
+from PhonoSearchLib import LangSearchEngine, QueryCache, canonical_phonemes, canonical_features
+from IPAParser import parse_inventory, QUERY_PARSE_CACHE
+from PhonoQuery import parse_query, phoneme_glyphs
+from PhonoGeo import in_box
 import json
 import csv
 import re
+import html
 import urllib.parse
 import time
+import os
+import sys
+import hashlib
+import threading
 
 SEARCH_JS_TEMPLATE = """
     <script>
@@ -67,7 +75,129 @@ ADD_MAP = """$(document).ready(function() {
                 });
             """
 
+# Maps with more markers than this get languages binned into cells on the
+# server (see get_map_clusters) instead of one marker per language.
+MAP_MARKER_LIMIT = 1000
+# Up to this zoom level the cells of the whole map are sent; above it only
+# those in the visible part.
+MAP_FULL_ZOOM = 5
+MAP_MAX_ZOOM = 20
+
+# A piece of JS, which shows languages binned into cells on a map: one
+# marker per cell, with the number of languages and their families in the
+# title; cells with one language link to its entry. showClusterMap takes
+# the initial zoom level, the cells for it, and the parameters of the
+# search for /map_clusters, from which the cells are fetched again when
+# the map is zoomed or moved. Several maps can be shown on one page.
+CLUSTER_MAP = """
+    function drawClusters(map, markers, clusters, colorOf) {
+        for (var i = 0; i < markers.length; i++) {
+            markers[i].setMap(null);
+        }
+        markers.length = 0;
+        for (var i = 0; i < clusters.length; i++) {
+            var cell = clusters[i];
+            var families = [];
+            for (var family in cell[3]) {
+                if (cell[3].hasOwnProperty(family)) {
+                    families.push(family);
+                }
+            }
+            if (cell[2] == 1) {
+                var title = cell[4].split('#')[0] + ", " + families[0];
+            } else {
+                var title = cell[2] + " languages: " + families.map(function(family) {return family + " " + cell[3][family]}).join(", ");
+            }
+            var marker = new google.maps.Marker({
+                position: new google.maps.LatLng(cell[0], cell[1]),
+                map: map,
+                title: title,
+                label: cell[2] > 1 ? String(cell[2]) : null,
+                icon: {
+                    path: google.maps.SymbolPath.CIRCLE,
+                    fillColor: colorOf(families[0]),
+                    fillOpacity: 1,
+                    scale: 6 + 3 * Math.log(cell[2]) / Math.LN2,
+                    strokeWeight: 1,
+                    strokeColor: "black"
+                }
+            });
+            google.maps.event.addListener(marker, 'click', makeClusterFunction(map, cell));
+            markers.push(marker);
+        }
+    }
+    function makeClusterFunction(map, cell) {
+        return function() {
+            if (cell[4]) {
+                window.location.assign(window.location.protocol + "//" + window.location.host + "/listview" + "?lang=" + encodeURIComponent(cell[4]));
+            } else {
+                map.setCenter(new google.maps.LatLng(cell[0], cell[1]));
+                map.setZoom(map.getZoom() + 2);
+            }
+        }
+    }
+    function showClusterMap(canvasId, center, colorOf, zoom, clusters, clusterQuery) {
+        var map = new google.maps.Map(document.getElementById(canvasId), {
+            zoom: zoom,
+            center: center,
+            mapTypeId: google.maps.MapTypeId.TERRAIN
+        });
+        var markers = [];
+        drawClusters(map, markers, clusters, colorOf);
+        var shown = "zoom=" + zoom;
+        google.maps.event.addListener(map, 'idle', function() {
+            var request = "zoom=" + map.getZoom();
+            if (map.getZoom() > """ + str(MAP_FULL_ZOOM) + """) {
+                var bounds = map.getBounds();
+                request += "&south=" + bounds.getSouthWest().lat().toFixed(2) + "&west=" + bounds.getSouthWest().lng().toFixed(2) +
+                    "&north=" + bounds.getNorthEast().lat().toFixed(2) + "&east=" + bounds.getNorthEast().lng().toFixed(2);
+            }
+            if (request == shown) {
+                return;
+            }
+            shown = request;
+            $.getJSON("/map_clusters?" + clusterQuery + request, function(clusters) {
+                if (request == shown) {
+                    drawClusters(map, markers, clusters, colorOf);
+                }
+            });
+        });
+    }
+"""
+
+# Shows the results of a search as cells instead of ADD_MAP.
+ADD_CLUSTER_MAP = CLUSTER_MAP + """
+    $(document).ready(function() {
+        var count = 0,
+            meanLat = 0,
+            meanLon = 0;
+        for (var i = 0; i < clusterData.length; i++) {
+            count += clusterData[i][2];
+            meanLat += clusterData[i][0] * clusterData[i][2];
+            meanLon += clusterData[i][1] * clusterData[i][2];
+        }
+        $("#mapCanvas").css({"width": "800px", "height": "500px"});
+        showClusterMap("mapCanvas", new google.maps.LatLng(meanLat / count, meanLon / count), function(family) {return "yellow"}, clusterZoom, clusterData, clusterQuery);
+    });
+"""
+
+def cluster_query(query, search_type = None):
+    """The parameters of /map_clusters for a search (or for all the
+    languages), ready to be followed by more."""
+    parameters = { 'type': search_type, 'query': query['query'][0] } if search_type else {}
+    if 'dialects' in query:
+        parameters['dialects'] = 'true'
+    result = urllib.parse.urlencode(parameters)
+    return result + "&" if result else result
+
+def cluster_data(query, search_type = None):
+    """The JS variables needed by ADD_CLUSTER_MAP for the results of a
+    search (or for all the languages)."""
+    return "var clusterZoom = 3;\nvar clusterQuery = " + json.dumps(cluster_query(query, search_type)) + \
+        ";\nvar clusterData = " + json.dumps(map_clusters(search_type, query, 3), ensure_ascii = False) + ";\n"
+
 def get_homepage():
+    engine = current_engine()
     link = ""
     script = ""
     content = """
@@ -76,7 +206,7 @@ def get_homepage():
 <h3>How to access the data</h3>
 <p>There are three views of the database: <a href="mapview">mapview</a>, <a href="listview">listview</a>, and <a href="segments">segment view</a>. The <a href="mapview">mapview</a> shows all the languages on the map with colours of the points corresponding to families. The entries on the languages can be accessed by clicking on the markers. The <a href="listview">listview</a> shows the languages organised according to their genealogical affiliation and in the alphabetical order. The two-tier description consisting of family (~Indo-European) and group (~Slavic, Germanic) is used. The <a href="segments">segment view</a> presents all the segments that can be found in the languages in the database. The distribution of each segment can be accessed by clicking on it.</p>
 <p>The <a href="reports">family/group reports</a> section provides some info on particular families and groups.</p>
-<p>There are three ways to query the database. The <a href="search_exact">exact search</a> returns the distribution of individual phonemes and combinations of phonemes (inluding phoneme gaps) in the covered languages. The <a href="search_fuzzy">fuzzy search</a> finds all variants of a base phoneme and their distribution. The <a href="search_feature">feature search</a> finds inventories displaying a particular combination of IPA features (including feature gaps).</p>
+<p>There are four ways to query the database. The <a href="search_exact">exact search</a> returns the distribution of individual phonemes and combinations of phonemes (inluding phoneme gaps) in the covered languages. The <a href="search_fuzzy">fuzzy search</a> finds all variants of a base phoneme and their distribution. The <a href="search_feature">feature search</a> finds inventories displaying a particular combination of IPA features (including feature gaps). The <a href="search_boolean">boolean search</a> combines phonemes and features with AND, OR, and NOT.</p>
 <h3>Data dump</h3>
 <p>The latest version of the database can be downloaded <a href="http://eurasianphonology.info/static/phono_dbase.json">as a JSON-file</a>.
 <h3>Source code</h3>
@@ -85,8 +215,8 @@ def get_homepage():
 <p>Nikolaev, Dmitry; Andrey Nikulin; and Anton Kukhto. 2015. The database of Eurasian phonological inventories. (Available online at http://eurasianphonology.info ; accessed on {currentDate})</p>
 <p>To cite individual language descriptions, give the source provided in the database record followed by In: Nikolaev, Dmitry; Andrey Nikulin; and Anton Kukhto. 2015. The database of Eurasian phonological inventories. (Available online at http://eurasianphonology.info ; accessed on {currentDate}.)</p>
     """
-    nvars  = len(engine_w_dialects.all_langs)
-    nlangs = len(engine.all_langs)
+    nvars  = len(engine.get_langs(with_dialects = True))
+    nlangs = len(engine.get_langs(with_dialects = False))
     ndials = nvars - nlangs
     currentDate = time.strftime('%B %d, %Y')
     content = content.format(nvars = nvars, nlangs = nlangs, ndials = ndials, currentDate = currentDate)
@@ -94,8 +224,12 @@ def get_homepage():
     return data.encode()
 
 def get_mapview(dialects = False):
-    family_dic = { key: engine.lang_dic[key]["gen"] for key in engine.lang_dic }
-    coords_dic = { key: engine.lang_dic[key]["coords"] for key in engine.lang_dic }
+    engine = current_engine()
+    langs = [key for key in engine.lang_dic if dialects or key not in engine.dialects]
+    if len(langs) > MAP_MARKER_LIMIT:
+        return get_cluster_mapview(dialects)
+    family_dic = { key: engine.lang_dic[key]["gen"] for key in langs }
+    coords_dic = { key: engine.lang_dic[key]["coords"] for key in langs }
     script = """
     <script>
     var colorNames = ["aquamarine", "brown", "burlywood", "cadetblue", "chartreuse", "chocolate", "coral", "cornflowerblue", "cornsilk", "crimson", "cyan", "darkblue", "darkcyan", "darkgoldenrod", "darkgray", "darkgreen", "darkgrey", "darkkhaki", "darkmagenta", "darkolivegreen", "darkorange", "darkorchid", "plum", "powderblue", "purple", "red", "rosybrown", "royalblue", "saddlebrown", "salmon", "sandybrown", "seagreen", "seashell"];
@@ -169,6 +303,8 @@ def get_mapview(dialects = False):
     return data.encode()
 
 def get_listview(query):
+    engine = current_engine()
+    phyla_dic, family_dic, group_dic = engine.get_genealogy(with_dialects = False)
     content = """<br/>
     <div class="container-fluid">
         <div class="row">
@@ -211,8 +347,8 @@ def get_listview(query):
     else:
         current_fam = current_group = current_lang = '"default"'
 
-    phyla_dic_list = { key: list(item) for key, item in engine.phyla_dic.items() if item or item == "Isolate"}
-    script = script.format(phyloData = json.dumps(phyla_dic_list) + ";\n", groupData = json.dumps(engine.group_dic) + ";\n", current_fam = current_fam, current_group = current_group, current_lang = current_lang)
+    phyla_dic_list = { key: list(item) for key, item in phyla_dic.items() if item or item == "Isolate"}
+    script = script.format(phyloData = json.dumps(phyla_dic_list) + ";\n", groupData = json.dumps(group_dic) + ";\n", current_fam = current_fam, current_group = current_group, current_lang = current_lang)
 
     script += """
     function repopulateListGroups(familyList) {
@@ -267,27 +403,27 @@ def get_listview(query):
     </script>"""
 
     families = []
-    sorted_families = [item for item in sorted(engine.phyla_dic)]
+    sorted_families = [item for item in sorted(phyla_dic)]
     for family in sorted_families:
         families.append('<option value="{value}">{name}</option>'.format(value=family, name=family))
     families = '\n'.join(families)
     first_family = sorted_families[0]
 
     groups = []
-    sorted_groups = sorted(engine.phyla_dic[first_family])
+    sorted_groups = sorted(phyla_dic[first_family])
     for group in sorted_groups:
         groups.append('<option value="{value}">{name}</option>'.format(value=group, name=group))
     groups = '\n'.join(groups)
     first_group = sorted_groups[0]
 
     langs = []
-    sorted_langs = sorted(engine.group_dic[first_group])
+    sorted_langs = sorted(group_dic[first_group])
     for lang in sorted_langs:
         langs.append('<option value="{value}">{name}</option>'.format(value=lang, name=lang.split('#')[0]))
     langs = '\n'.join(langs)
 
     langs_alpha = []
-    all_langs = sorted(engine.all_langs);
+    all_langs = sorted(engine.get_langs(with_dialects = False));
     for lang in all_langs:
         langs_alpha.append('<option value="{value}">{name}</option>'.format(value=lang, name=lang.split('#')[0]))
     langs_alpha = '\n'.join(langs_alpha)
@@ -296,6 +432,7 @@ def get_listview(query):
     return data.encode()
 
 def get_segments():
+    engine = current_engine()
     script = """
     <script>
     function searchForThis(s) {
@@ -315,11 +452,13 @@ def get_segments():
     }
     </style>
     """
-    content = engine_w_dialects.get_full_table()
+    content = engine.get_full_table()
     data = template.format(link = link, script = script, content = content)
     return data.encode()
 
 def get_reports_page(query, chosen_stock = None):
+    engine = current_engine()
+    phyla_dic, family_dic, group_dic = engine.get_genealogy(with_dialects = False)
     link = """<script src="https://maps.googleapis.com/maps/api/js?v=3.exp"></script>
     <script type="text/javascript" src="https://www.google.com/jsapi"></script>
     <script type="text/javascript" charset="utf-8">
@@ -352,8 +491,8 @@ def get_reports_page(query, chosen_stock = None):
     else:
         current_fam = current_group = '"default"'
 
-    phyla_dic_list = { key: list(item) for key, item in engine.phyla_dic.items() if item or item == "Isolate" }
-    script = script.format(phyloData = json.dumps(phyla_dic_list) + ";\n", groupData = json.dumps(engine.group_dic) + ";\n", current_fam = current_fam, current_group = current_group)
+    phyla_dic_list = { key: list(item) for key, item in phyla_dic.items() if item or item == "Isolate" }
+    script = script.format(phyloData = json.dumps(phyla_dic_list) + ";\n", groupData = json.dumps(group_dic) + ";\n", current_fam = current_fam, current_group = current_group)
 
     script += """
     function repopulateGroups(familyList) {
@@ -451,14 +590,14 @@ def get_reports_page(query, chosen_stock = None):
     {report}
     """
     families = []
-    sorted_families = [item for item in sorted(engine.phyla_dic)]
+    sorted_families = [item for item in sorted(phyla_dic)]
     for family in sorted_families:
         families.append('<option value="{value}">{name}</option>'.format(value=family, name=family))
     families = '\n'.join(families)
     first_family = sorted_families[0]
 
     groups = []
-    sorted_groups = sorted(engine.phyla_dic[first_family])
+    sorted_groups = sorted(phyla_dic[first_family])
     for group in sorted_groups:
         groups.append('<option value="{value}">{name}</option>'.format(value=group, name=group))
     groups = '\n'.join(groups)
@@ -531,18 +670,9 @@ def get_reports_page(query, chosen_stock = None):
             {phono_table}
         </div>
         """
-        langs_to_report = engine.group_dic[query['group'][0]]
-        report_dic = {}
-        report_dic["map_data"] = []
-        for lang in langs_to_report:
-            report_dic["map_data"].append(
-                [lang.split('#')[0],
-                engine.lang_dic[lang]["coords"][0],
-                engine.lang_dic[lang]["coords"][1]]
-                )
-        report_dic["inv_sizes"] = engine.get_inv_sizes(langs_to_report)
-        data = "var reportData = " + json.dumps(report_dic, indent = 2) + ";\n"
-        phono_table = engine.get_common_table(langs_to_report)
+        report_dic = engine.get_report('group', query['group'][0], with_dialects = False)
+        data = "var reportData = " + json.dumps({ "map_data": report_dic["map_data"], "inv_sizes": report_dic["inv_sizes"] }, indent = 2) + ";\n"
+        phono_table = report_dic["table_of_common_phons"]
         report = report_start.format(data = data) + report + report_div.format(data = data, phono_table = phono_table)
 
     elif current_fam != '"default"':
@@ -620,19 +750,9 @@ def get_reports_page(query, chosen_stock = None):
             {phono_table}
         </div>
         """
-        langs_to_report = engine.family_dic[query['family'][0]]
-        report_dic = {}
-        report_dic["map_data"] = []
-        for lang in langs_to_report:
-            report_dic["map_data"].append(
-                [lang.split('#')[0],
-                engine.lang_dic[lang]["gen"][1],
-                engine.lang_dic[lang]["coords"][0],
-                engine.lang_dic[lang]["coords"][1]]
-                )
-        report_dic["inv_sizes"] = engine.get_inv_sizes(langs_to_report)
-        data = "var reportData = " + json.dumps(report_dic, indent = 2) + ";\n"
-        phono_table = engine.get_common_table(langs_to_report)
+        report_dic = engine.get_report('family', query['family'][0], with_dialects = False)
+        data = "var reportData = " + json.dumps({ "map_data": report_dic["map_data"], "inv_sizes": report_dic["inv_sizes"] }, indent = 2) + ";\n"
+        phono_table = report_dic["table_of_common_phons"]
         report = report_start.format(data = data) + report + report_div.format(data = data, phono_table = phono_table)
     else:
         print("Lists only")
@@ -657,54 +777,122 @@ def format_table(table, css_class = ""):
         rows_arr.append(new_row)
     return result.format(css_class = ' class="%s"' % css_class, rows = ''.join(rows_arr))
 
-def search(search_type, query):
-    if search_type == 'exact':
-        phono_list = re.split(r'\s*,\s*', query['query'][0])
-        phono_string = ', '.join(phono_list)
-        if 'dialects' in query:
-            result = sorted(engine_w_dialects.IPA_query_multiple(*phono_list))
+def describe_parse_errors(glyphs):
+    """Returns a message about the glyphs of a query which cannot be parsed or an empty string."""
+    glyphs = [glyph[1:] if glyph.startswith('-') else glyph for glyph in glyphs]
+    _, errors = parse_inventory(glyphs, QUERY_PARSE_CACHE)
+    if not errors:
+        return ""
+    items = []
+    for error in errors:
+        if error.codepoint is not None:
+            items.append("<li>‘%s’: unexpected symbol %s at position %d</li>" % (html.escape(error.glyph), error.codepoint, error.position + 1))
         else:
-            result = sorted(engine.IPA_query_multiple(*phono_list))
-        table = []
-        for lang in result:
-            table.append([
-                    lang_dic[lang]["name"], lang_dic[lang]["code"], lang_dic[lang]["coords"][0], lang_dic[lang]["coords"][1], lang_dic[lang]["gen"][0], lang_dic[lang]["gen"][1]
-                ])
-        return table
-    elif search_type == 'superset':
-        if 'dialects' in query:
-            try:
-                result = engine_w_dialects.IPA_query(query['query'][0]) # A dictionary
-            except:
-                result = {}
-        else:
-            try:
-                result = engine.IPA_query(query['query'][0])
-            except:
-                result = {}
-        result_dic = {}
-        for key in result:
-            result_dic[key] = []
-            for lang in result[key]:
-                result_dic[key].append([
-                    lang_dic[lang]["name"], lang_dic[lang]["code"], lang_dic[lang]["coords"][0], lang_dic[lang]["coords"][1], lang_dic[lang]["gen"][0], lang_dic[lang]["gen"][1]
-                ])
-        return result_dic
+            items.append("<li>‘%s’: %s</li>" % (html.escape(error.glyph), html.escape(error.reason)))
+    return "<strong>Malformed request!</strong><ul>%s</ul>" % ''.join(items)
+
+def get_cluster_mapview(dialects = False):
+    """The mapview with languages binned into cells, for large databases."""
+    script = """
+    <script>
+    var colorNames = ["aquamarine", "brown", "burlywood", "cadetblue", "chartreuse", "chocolate", "coral", "cornflowerblue", "cornsilk", "crimson", "cyan", "darkblue", "darkcyan", "darkgoldenrod", "darkgray", "darkgreen", "darkgrey", "darkkhaki", "darkmagenta", "darkolivegreen", "darkorange", "darkorchid", "plum", "powderblue", "purple", "red", "rosybrown", "royalblue", "saddlebrown", "salmon", "sandybrown", "seagreen", "seashell"];
+    var markerColors = {};
+    function familyColor(family) {
+        if (!markerColors.hasOwnProperty(family)) {
+            markerColors[family] = colorNames[Object.keys(markerColors).length % colorNames.length];
+        }
+        return markerColors[family];
+    }
+    """ + cluster_data({ 'dialects': ['true'] } if dialects else {}) + CLUSTER_MAP + \
+    """$( document ).ready(function() {
+        var height = $(window).height() - 115;
+        $("#container").css({"height": height});
+        $(window).resize(function() {
+            $("#container").css({"height": $(window).height() - $('#header').height()});
+        });
+        showClusterMap("container", new google.maps.LatLng(48, 87.637515), familyColor, clusterZoom, clusterData, clusterQuery);
+    });
+    </script>
+    """
+    data = template.format(link = """<script type="text/javascript" src="http://maps.google.com/maps/api/js?sensor=false"></script>""", script = script, content = "")
+    return data.encode()
+
+def lang_row(lang):
+    engine = current_engine()
+    lang_dic = engine.lang_dic
+    return [lang_dic[lang]["name"], lang_dic[lang]["code"], lang_dic[lang]["coords"][0], lang_dic[lang]["coords"][1], lang_dic[lang]["gen"][0], lang_dic[lang]["gen"][1]]
+
+def search_langs(search_type, query):
+    """Returns the cache key of an exact, feature, or boolean search and a
+    function computing the set of languages found."""
+    engine = current_engine()
+    with_dialects = 'dialects' in query
+    if search_type == 'exact':
+        phono_list = [term.strip() for term in re.split(r'\s*,\s*', query['query'][0])]
+        key = (engine.version, 'exact', with_dialects, canonical_phonemes(*phono_list))
+        return key, lambda: engine.IPA_query_multiple(*phono_list, exact = True, with_dialects = with_dialects)
     elif search_type == 'feature':
-        feature_list = re.split(r'\s*,\s*', query['query'][0])
-        if 'dialects' in query:
-            result = sorted(engine_w_dialects.features_query(*feature_list))
-        else:
-            result = sorted(engine.features_query(*feature_list))
-        table = []
-        for lang in result:
-            table.append([
-                    lang_dic[lang]["name"], lang_dic[lang]["code"], lang_dic[lang]["coords"][0], lang_dic[lang]["coords"][1], lang_dic[lang]["gen"][0], lang_dic[lang]["gen"][1]
-                ])
-        return table
+        feature_list = [term.strip() for term in re.split(r'\s*,\s*', query['query'][0])]
+        key = (engine.version, 'feature', with_dialects, canonical_features(*feature_list))
+        return key, lambda: engine.features_query(*feature_list, with_dialects = with_dialects)
+    elif search_type == 'boolean':
+        key = (engine.version, 'boolean', with_dialects, parse_query(query['query'][0]))
+        return key, lambda: engine.boolean_query(key[3], with_dialects)
+    raise Exception("Unknown search type %s" % search_type)
+
+def search(search_type, query):
+    """Returns the result table for a query. Results are cached under a
+    canonical form of the query and the version of the engine, so they must
+    not be modified."""
+    engine = current_engine()
+    with_dialects = 'dialects' in query
+    if search_type in ('exact', 'feature', 'boolean'):
+        key, compute = search_langs(search_type, query)
+        return query_cache.get(key, lambda: [lang_row(lang) for lang in sorted(compute())])
+    elif search_type == 'superset':
+        _, errors = parse_inventory(query['query'][:1], QUERY_PARSE_CACHE)
+        if errors:
+            return {}
+        key = (engine.version, 'superset', with_dialects, canonical_phonemes(query['query'][0]))
+        def compute():
+            result = engine.IPA_query(query['query'][0], with_dialects) # A dictionary
+            return { glyph: [lang_row(lang) for lang in langs] for glyph, langs in result.items() }
+        return query_cache.get(key, compute)
     else:
         return None
 
+def map_clusters(search_type, query, zoom):
+    """Returns the languages found by a search (all of them if search_type
+    is None) binned into cells for a map at a zoom level. Cached like
+    search()."""
+    engine = current_engine()
+    with_dialects = 'dialects' in query
+    if search_type is None:
+        key = (engine.version, 'all', with_dialects)
+        compute = lambda: None
+    else:
+        key, compute = search_langs(search_type, query)
+    return query_cache.get(key + ('clusters', zoom), lambda: engine.map_clusters(zoom, compute(), with_dialects))
+
+def get_map_clusters(query):
+    """Map cells as JSON: for all the languages, or for the results of a
+    search given by type (exact, feature, or boolean) and query; zoom is the
+    zoom level of the map, and south, west, north, and east optionally limit
+    the cells to the visible part of it."""
+    zoom = min(max(int(query.get('zoom', ['3'])[0]), 0), MAP_MAX_ZOOM)
+    clusters = map_clusters(query.get('type', [None])[0], query, zoom)
+    if all(side in query for side in ('south', 'west', 'north', 'east')):
+        south, west, north, east = (float(query[side][0]) for side in ('south', 'west', 'north', 'east'))
+        clusters = [cell for cell in clusters if in_box(cell[0], cell[1], south, west, north, east)]
+    return json.dumps(clusters, ensure_ascii = False).encode()
+
+def get_cache_stats():
+    stats = {
+        "query_cache": query_cache.info(),
+        "query_parse_cache": QUERY_PARSE_CACHE.info()
+    }
+    return json.dumps(stats, indent = 2).encode()
+
 def get_exact_search(query = None):
     # DESCRIBE MULTIPLE SEARCH!!!
     link = """<script type="text/javascript" src="http://maps.google.com/maps/api/js?sensor=false"></script>"""
@@ -722,18 +910,22 @@ def get_exact_search(query = None):
   <div id="mapCanvas"></div>
   <div id="reportCanvas">{response}</div>
 </div>"""
-    if not query:
-        response = report_data = add_map = ""
-    else:
+    response = report_data = add_map = ""
+    if query:
+        response = describe_parse_errors(re.split(r'\s*,\s*', query['query'][0]))
+    if query and not response:
         try:
             results = search("exact", query)
-            if results:
+            if len(results) > MAP_MARKER_LIMIT:
+                response = format_table(results, "search_results")
+                report_data = cluster_data(query, "exact")
+                add_map = ADD_CLUSTER_MAP
+            elif results:
                 response = format_table(results, "search_results")
                 report_data = "var reportData = " + json.dumps(results, indent = 2, ensure_ascii = False) + ';\n'
                 add_map = ADD_MAP
             else:
                 response = "The phoneme or combination of phonemes was not found."
-                report_data = add_map = ""
         except:
             response = "<strong>Malformed request!</strong>"
             report_data = add_map = ""
@@ -742,6 +934,22 @@ def get_exact_search(query = None):
     data = template.format(link = link, script = script, content = content)
     return data.encode()
 
+def fuzzy_cluster_data(query, results):
+    """reportData for the fuzzy search with a map of cells for each variant:
+    glyph -> the names of the languages, the parameters of /map_clusters
+    (an exact search for the variant), and the cells at zoom level 2."""
+    report = {}
+    for glyph, rows in results.items():
+        variant = { 'query': [glyph] }
+        if 'dialects' in query:
+            variant['dialects'] = query['dialects']
+        report[glyph] = {
+            "langs": [row[0] for row in rows],
+            "query": cluster_query(variant, 'exact'),
+            "clusters": map_clusters('exact', variant, 2)
+        }
+    return report
+
 def get_fuzzy_search(query = None):
     link = """<script type="text/javascript" src="http://maps.google.com/maps/api/js?sensor=false"></script>"""
     script = SEARCH_JS_TEMPLATE
@@ -756,17 +964,36 @@ def get_fuzzy_search(query = None):
     <p class="info">Input a base phoneme in terms of IPA symbols. The search engine will provide all phonemes from the database which include all the features of the base phoneme along with their distributions. An example search: ‘p’.</p>
     <div id="reportCanvas">{response}</div>
 </div>"""
-    if not query:
-        response = report_data = add_map = ""
-    else:
+    response = report_data = add_map = ""
+    if query:
+        response = describe_parse_errors(query['query'][:1])
+    if query and not response:
         results = search('superset', query)
         if not results:
             response = "Nothing found."
             report_data = add_map = ""
         else:
             response = ""
-            report_data = "\tvar query = \"" + query['query'][0] + "\";\n\tvar reportData = " + json.dumps(results, indent = 2, ensure_ascii = False) + ';\n'
-            add_map = """
+            if sum(len(rows) for rows in results.values()) > MAP_MARKER_LIMIT:
+                report_data = "\tvar query = \"" + query['query'][0] + "\";\n\tvar reportData = " + json.dumps(fuzzy_cluster_data(query, results), ensure_ascii = False) + ';\n'
+                add_map = CLUSTER_MAP + """
+            function addSubreport(count, phoneme, subreport) {
+                var p = $("<p>")
+                if (subreport.langs.length > 1) {
+                    var langs = " languages: ";
+                } else {
+                    var langs = " language: ";
+                }
+                p.append($("<b>").html("<span class='phono'>" + phoneme + "</span>, " + subreport.langs.length + langs))
+                p.append(subreport.langs.join(', '));
+                $("#reportCanvas").append(p);
+                var mapCanvasId = "map_canvas_" + count;
+                $("#reportCanvas").append($("<div>").attr("id", mapCanvasId).css({"width": "600px", "height": "375px", "margin-top": "20px", "margin-bottom": "20px", "background-color": "beige"}))
+                showClusterMap(mapCanvasId, new google.maps.LatLng(48, 87.637515), function(family) {return "yellow"}, 2, subreport.clusters, subreport.query);
+            }"""
+            else:
+                report_data = "\tvar query = \"" + query['query'][0] + "\";\n\tvar reportData = " + json.dumps(results, indent = 2, ensure_ascii = False) + ';\n'
+                add_map = """
             function addSubreport(count, phoneme, langTable) {
                 var p = $("<p>")
                 if (langTable.length > 1) {
@@ -807,7 +1034,8 @@ def get_fuzzy_search(query = None):
                         }
                     });
                 }
-            }
+            }"""
+            add_map += """
             $(document).ready(function () {
                 var keys = [];
                 for (var key in reportData) {
@@ -857,7 +1085,11 @@ def get_feature_search(query = None):
         response = report_data = add_map = ""
     else:
         results = search("feature", query)
-        if results:
+        if len(results) > MAP_MARKER_LIMIT:
+            response = format_table(results, "search_results")
+            report_data = cluster_data(query, "feature")
+            add_map = ADD_CLUSTER_MAP
+        elif results:
             response = format_table(results, "search_results")
             report_data = "var reportData = " + json.dumps(results, indent = 2, ensure_ascii = False) + ';\n'
             add_map = ADD_MAP
@@ -868,10 +1100,84 @@ def get_feature_search(query = None):
     data = template.format(link = link, script = script, content = content)
     return data.encode()
 
+def get_boolean_search(query = None):
+    link = """<script type="text/javascript" src="http://maps.google.com/maps/api/js?sensor=false"></script>"""
+    script = SEARCH_JS_TEMPLATE
+    content = """<div id="main">
+    <div id="searchFields">
+    <label for="include_dialects">Include dialects: </label>
+    <input id="include_dialects" type="checkbox">
+    <br/>
+    <label class="search_label" for="search_field">Boolean search: </label>
+    <input id="search_field" type="text"><input onclick="sendQuery(this)" value="Submit" id="boolean_search_btn" type="button">
+    <p class="info">Combine phonemes and features with AND, OR, NOT, and parentheses. Phonemes are matched exactly; a phoneme followed by ‘*’ also matches all its variants (as in the fuzzy search). Features are given as in the feature search and match inventories with a segment having all of them. NOT binds tighter than AND, and AND tighter than OR; a comma can be used instead of AND and a ‘-’ instead of NOT. An example search: <span class="phono">‘(ʈ OR ɖ) AND NOT retroflex fricative’</span>.</p>
+    <div id="mapCanvas"></div>
+    <div id="reportCanvas">{response}</div>
+</div>"""
+    response = report_data = add_map = ""
+    if query:
+        response = describe_parse_errors(phoneme_glyphs(query['query'][0]))
+    if query and not response:
+        try:
+            results = search("boolean", query)
+        except Exception as error:
+            results = None
+            response = "<strong>Malformed request!</strong> %s" % html.escape(str(error))
+        if results and len(results) > MAP_MARKER_LIMIT:
+            response = format_table(results, "search_results")
+            report_data = cluster_data(query, "boolean")
+            add_map = ADD_CLUSTER_MAP
+        elif results:
+            response = format_table(results, "search_results")
+            report_data = "var reportData = " + json.dumps(results, indent = 2, ensure_ascii = False) + ';\n'
+            add_map = ADD_MAP
+        elif results is not None:
+            response = "Nothing found."
+    script = script.format(report_data = report_data, add_map = add_map)
+    content = content.format(response = response)
+    data = template.format(link = link, script = script, content = content)
+    return data.encode()
+
+def current_engine():
+    """The engine for the current request: the same one throughout the
+    request, even if a new one is swapped in meanwhile."""
+    return getattr(_request, 'engine', engine)
+
+def watch_dbase(interval):
+    """Polls the database file and, when its contents change, builds a new
+    engine and swaps it in. Runs in a background thread; requests are served
+    by the old engine until the new one is ready."""
+    global engine
+    stamp = None
+    seen_hash = engine.source_hash
+    while True:
+        time.sleep(interval)
+        try:
+            info = os.stat(DBASE_PATH)
+            new_stamp = (info.st_mtime_ns, info.st_size, info.st_ino)
+            if new_stamp == stamp:
+                continue
+            stamp = new_stamp
+            with open(DBASE_PATH, 'rb') as inp:
+                new_hash = hashlib.sha256(inp.read()).hexdigest()
+            if new_hash == seen_hash:
+                continue # Touched, but not changed.
+            seen_hash = new_hash
+            start = time.time()
+            new_engine = LangSearchEngine(DBASE_PATH, with_dialects = True, snapshot = SNAPSHOT_PATH)
+            engine = new_engine
+            print("Reloaded %s in %.2f s" % (DBASE_PATH, time.time() - start), file = sys.stderr)
+        except Exception as error:
+            # Most likely the file is being written; it will be picked up
+            # when its mtime changes again.
+            print("Failed to reload %s: %r" % (DBASE_PATH, error), file = sys.stderr)
+
 def app(environ, start_response):
+    _request.engine = engine
     url = urllib.parse.urlsplit(environ['RAW_URI'])
     query = urllib.parse.parse_qs(url.query)
     path = url.path.split('/')[1:]
+    content_type = 'text/html'
     # print(path)
     # print(query.encode('unicode_escape'))
     if not path[0]:
@@ -888,7 +1194,8 @@ def app(environ, start_response):
         data = get_segments()
     elif path[0] == 'reports':
         status = '200 OK'
-        data = get_reports_page(query)
+        key = (current_engine().version, 'reports', tuple(query.get('family', ())), tuple(query.get('group', ())))
+        data = query_cache.get(key, lambda: get_reports_page(query))
     elif path[0] == 'search_exact':
         status = '200 OK'
         data = get_exact_search(query)
@@ -898,6 +1205,22 @@ def app(environ, start_response):
     elif path[0] == 'search_feature':
         status = '200 OK'
         data = get_feature_search(query)
+    elif path[0] == 'search_boolean':
+        status = '200 OK'
+        data = get_boolean_search(query)
+    elif path[0] == 'map_clusters':
+        try:
+            data = get_map_clusters(query)
+            status = '200 OK'
+            content_type = 'application/json; charset=utf-8'
+        except Exception as error:
+            # The message may quote the query: not to be read as HTML.
+            status = '400 Bad Request'
+            content_type = 'text/plain; charset=utf-8'
+            data = str(error).encode()
+    elif path[0] == 'cache_stats':
+        status = '200 OK'
+        data = get_cache_stats()
     elif path[0] == 'get_data':
         status = '200 OK'
         data = str(path).encode() + str(query).encode()
@@ -905,16 +1228,32 @@ def app(environ, start_response):
         status = '404 Not Found'
         data = status.encode()
     response_headers = [
-        ('Content-type','text/html'),
+        ('Content-type', content_type),
         ('Content-Length', str(len(data)))
     ]
     start_response(status, response_headers)
     return iter([data])
 
-engine            = LangSearchEngine('dbase/phono_dbase.json', False)
-engine_w_dialects = LangSearchEngine('dbase/phono_dbase.json', True)
-with open('dbase/phono_dbase.json', 'r', encoding = 'utf-8') as inp:
-    lang_dic = json.load(inp)
+def start_reloading(interval):
+    """Starts watch_dbase in a background thread unless interval is 0."""
+    if interval:
+        threading.Thread(target = watch_dbase, args = (interval,), daemon = True).start()
+
+# Paths do not depend on the working directory of the importer. Both
+# settings below can be changed through the environment: an empty
+# PHONO_SNAPSHOT means no snapshot, and a PHONO_RELOAD_INTERVAL of 0 no
+# reloading (e.g. for tests).
+SRC_DIR         = os.path.dirname(os.path.abspath(__file__))
+DBASE_PATH      = os.path.join(SRC_DIR, 'dbase', 'phono_dbase.json')
+SNAPSHOT_PATH   = os.environ.get('PHONO_SNAPSHOT', os.path.join(SRC_DIR, 'dbase', 'phono_dbase.snapshot')) or None
+RELOAD_INTERVAL = float(os.environ.get('PHONO_RELOAD_INTERVAL', 5)) # Seconds between checks of the database file; 0 turns reloading off.
+
+# One engine with the dialects; pages which should not show them pass
+# with_dialects = False. It is replaced when the database file changes.
+engine = LangSearchEngine(DBASE_PATH, with_dialects = True, snapshot = SNAPSHOT_PATH)
+_request = threading.local()
+start_reloading(RELOAD_INTERVAL)
+query_cache = QueryCache(maxsize = 1024) # Results of search() and map_clusters(), and report pages.
 
-with open('../html/template.html', 'r', encoding = 'utf-8') as inp:
+with open(os.path.join(SRC_DIR, os.pardir, 'html', 'template.html'), 'r', encoding = 'utf-8') as inp:
     template = inp.read()
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Checks that every phoneme in the database can be parsed.
+
+Usage: python3 validateDbase.py [path] [--processes N] [--fields inv cons vows]
+
+Languages are split into chunks which are parsed across a process pool;
+within a worker every distinct glyph is parsed only once. Exits with
+status 1 if anything failed to parse."""
+
+import sys
+import json
+import time
+import argparse
+from multiprocessing import Pool, cpu_count
+from IPAParser import parse_inventory, FEATURE_NAMES
+
+FIELDS = ['inv', 'cons', 'vows']
+
+_records = [] # (lang, {field: glyphs}) pairs, set in each worker.
+
+def setRecords(records):
+    global _records
+    _records = records
+
+def parseChunk(bounds):
+    """Parses the inventories of _records[start:end]. Returns
+    (failures, glyphs, features, occurrences, seconds)."""
+    start = time.perf_counter()
+    records = _records[bounds[0] : bounds[1]]
+    failures = []
+    glyphs = set()
+    errors = {} # Bad glyph -> ParseError.
+    features = set()
+    occurrences = 0
+    for lang, inventories in records:
+        for field, inventory in inventories.items():
+            occurrences += len(inventory)
+            new = set(inventory).difference(glyphs)
+            if new:
+                glyphs.update(new)
+                parsed, new_errors = parse_inventory(new)
+                for phoneme in parsed:
+                    features.update(phoneme.key)
+                for error in new_errors:
+                    errors[error.glyph] = error
+            if errors and not errors.keys().isdisjoint(inventory):
+                for glyph in inventory:
+                    if glyph in errors:
+                        error = errors[glyph]
+                        failures.append({
+                            "lang": lang,
+                            "field": field,
+                            "glyph": glyph,
+                            "position": error.position,
+                            "codepoint": error.codepoint,
+                            "reason": error.reason
+                        })
+    return failures, glyphs, features, occurrences, time.perf_counter() - start
+
+def validate(lang_dic, fields = FIELDS, processes = None):
+    """Returns a report dict with the failures and summary statistics."""
+    start = time.perf_counter()
+    records = [(lang, { field: lang_dic[lang].get(field, []) for field in fields }) for lang in lang_dic]
+    processes = processes or cpu_count()
+    chunk_size = max(1, -(-len(records) // (processes * 4)))
+    chunks = [(i, i + chunk_size) for i in range(0, len(records), chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        # Workers get the records once, when they start (for free with fork),
+        # and then only chunk bounds.
+        with Pool(processes, initializer = setRecords, initargs = (records,)) as pool:
+            results = pool.map(parseChunk, chunks)
+    else:
+        processes = 1
+        setRecords(records)
+        results = [parseChunk(chunk) for chunk in chunks]
+    failures = []
+    glyphs = set()
+    features = set()
+    occurrences = 0
+    parse_time = 0.0
+    for chunk_failures, chunk_glyphs, chunk_features, chunk_occurrences, elapsed in results:
+        failures.extend(chunk_failures)
+        glyphs.update(chunk_glyphs)
+        features.update(chunk_features)
+        occurrences += chunk_occurrences
+        parse_time += elapsed
+    failures.sort(key = lambda item: (item["lang"], item["field"], item["glyph"]))
+    return {
+        "failures": failures,
+        "languages": len(lang_dic),
+        "glyph_occurrences": occurrences,
+        "distinct_glyphs": len(glyphs),
+        "bad_glyphs": len({ failure["glyph"] for failure in failures }),
+        "features": sorted(feature for feature in features if feature in FEATURE_NAMES),
+        "polyphthongs": sorted(feature for feature in features if feature not in FEATURE_NAMES),
+        "parse_time_per_glyph": parse_time / occurrences if occurrences else 0.0, # Per occurrence.
+        "processes": processes,
+        "wall_time": time.perf_counter() - start
+    }
+
+def printReport(report, out = sys.stdout):
+    for failure in report["failures"]:
+        if failure["codepoint"] is not None:
+            where = "%s at position %d" % (failure["codepoint"], failure["position"])
+        else:
+            where = "-"
+        print("%s\t%s\t%s\t%s\t%s" % (failure["lang"], failure["field"], failure["glyph"], where, failure["reason"]), file = out)
+    if report["failures"]:
+        print(file = out)
+    print("Languages:           %d" % report["languages"], file = out)
+    print("Glyph occurrences:   %d" % report["glyph_occurrences"], file = out)
+    print("Distinct glyphs:     %d" % report["distinct_glyphs"], file = out)
+    print("Unparsable glyphs:   %d (in %d inventories)" % (report["bad_glyphs"], len(report["failures"])), file = out)
+    print("Features used:       %d (and %d polyphthongs)" % (len(report["features"]), len(report["polyphthongs"])), file = out)
+    print("Parse time per glyph: %.2f us per occurrence" % (report["parse_time_per_glyph"] * 1e6), file = out)
+    print("Wall time:           %.3f s (%d processes)" % (report["wall_time"], report["processes"]), file = out)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Check that every phoneme in the database can be parsed.")
+    parser.add_argument("path", nargs = "?", default = "dbase/phono_dbase.json")
+    parser.add_argument("--processes", type = int, default = None, help = "size of the process pool (default: number of CPUs)")
+    parser.add_argument("--fields", nargs = "+", default = FIELDS, choices = FIELDS)
+    parser.add_argument("--features", action = "store_true", help = "also list all the features used")
+    args = parser.parse_args()
+    with open(args.path, 'r', encoding = 'utf-8') as inp:
+        lang_dic = json.load(inp)
+    report = validate(lang_dic, args.fields, args.processes)
+    printReport(report)
+    if args.features:
+        print("\n" + ", ".join(report["features"]))
+    return 1 if report["failures"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
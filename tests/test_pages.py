@@ -0,0 +1,81 @@
+"""Pages of the web app."""
+
+import os
+import sys
+import unittest
+import urllib.parse
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+
+new_run = None
+
+def setUpModule():
+    global new_run
+    # Neither a snapshot next to the database nor a thread watching it.
+    os.environ['PHONO_SNAPSHOT'] = ''
+    os.environ['PHONO_RELOAD_INTERVAL'] = '0'
+    sys.path.insert(0, SRC)
+    import new_run
+
+def get(url, with_headers = False):
+    response = []
+    body = b''.join(new_run.app({ 'RAW_URI': urllib.parse.quote(url, safe = '/?=&,%') }, lambda code, headers: response.append((code, dict(headers)))))
+    if with_headers:
+        return response[0][0], response[0][1], body.decode('utf-8')
+    return response[0][0], body.decode('utf-8')
+
+class ParseErrors(unittest.TestCase):
+    PAYLOAD = '<img/src=x/onerror=alert(1)>'
+
+    def assertEscaped(self, url):
+        status, body = get(url)
+        self.assertEqual(status, '200 OK')
+        self.assertIn('Malformed request!', body)
+        self.assertNotIn(self.PAYLOAD, body)
+        self.assertIn('&lt;img/src=x/onerror=alert(1)&gt;', body)
+
+    def test_exact_search(self):
+        self.assertEscaped('/search_exact?query=' + self.PAYLOAD)
+
+    def test_fuzzy_search(self):
+        self.assertEscaped('/search_fuzzy?query=' + self.PAYLOAD)
+
+    def test_boolean_search(self):
+        # Parentheses are operators there, so the payload does without them.
+        status, body = get('/search_boolean?query=p AND <svg/onload=alert`1`>')
+        self.assertIn('Malformed request!', body)
+        self.assertNotIn('<svg/onload=alert`1`>', body)
+        self.assertIn('&lt;svg/onload=alert`1`&gt;', body)
+
+    def test_map_clusters(self):
+        for url in ('/map_clusters?zoom=3&type=boolean&query=p AND <svg/onload=alert`1`>', '/map_clusters?zoom=3&type=exact&query=' + self.PAYLOAD):
+            status, headers, body = get(url, with_headers = True)
+            self.assertEqual(status, '400 Bad Request')
+            self.assertTrue(headers['Content-type'].startswith('text/plain'))
+        status, headers, body = get('/map_clusters?zoom=3&type=exact&query=p', with_headers = True)
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers['Content-type'].startswith('application/json'))
+
+class ClusterMaps(unittest.TestCase):
+    def setUp(self):
+        self.limit = new_run.MAP_MARKER_LIMIT
+        new_run.MAP_MARKER_LIMIT = 10
+
+    def tearDown(self):
+        new_run.MAP_MARKER_LIMIT = self.limit
+
+    def test_search_pages(self):
+        for url in ('/mapview', '/search_exact?query=p', '/search_feature?query=plosive', '/search_boolean?query=p OR k', '/search_fuzzy?query=p'):
+            status, body = get(url)
+            self.assertEqual(status, '200 OK')
+            self.assertIn('showClusterMap(', body)
+
+    def test_fuzzy_search(self):
+        status, body = get('/search_fuzzy?dialects=true&query=k')
+        self.assertIn('"query": "type=exact&query=k&dialects=true&"', body)
+        self.assertIn('"clusters": [[', body)
+        # No rows of language data, as in the page with one marker per language.
+        self.assertNotIn('"Indo-European",', body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Snapshots made by one process and loaded by another."""
+
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+DBASE = os.path.join(SRC, 'dbase', 'phono_dbase.json')
+
+BUILD = """
+from PhonoSearchLib import LangSearchEngine
+LangSearchEngine(%(dbase)r, snapshot = %(snapshot)r)
+"""
+
+# Removes every language, or replaces every language with its own record,
+# and checks that no phoneme is left behind in the tables.
+CHANGE = """
+import json
+from PhonoSearchLib import LangSearchEngine
+engine = LangSearchEngine(%(dbase)r, snapshot = %(snapshot)r)
+for lang in sorted(engine.inv_dic):
+    if %(update)r:
+        engine.update_language(lang, json.loads(json.dumps(engine.lang_dic[lang])))
+    else:
+        engine.remove_language(lang)
+cells = [cell for table in (engine.cons_table, engine.vow_table) for row in table for cell in row]
+kept = sum(len(cell) for cell in cells) + len(engine.non_systematic)
+print(json.dumps([len(engine.inv_dic), len(engine.all_phonemes), kept]))
+"""
+
+def run(code, seed, **params):
+    env = dict(os.environ, PYTHONHASHSEED = str(seed))
+    result = subprocess.run([sys.executable, '-c', code % params], cwd = SRC, env = env,
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return result.stdout
+
+class SnapshotAcrossProcesses(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'phono_dbase.snapshot')
+        run(BUILD, 1, dbase = DBASE, snapshot = self.snapshot)
+        self.stamp = os.stat(self.snapshot).st_mtime_ns
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def change(self, update):
+        for seed in (2, 3):
+            output = run(CHANGE, seed, dbase = DBASE, snapshot = self.snapshot, update = update)
+            # The engine was loaded from the snapshot, not rebuilt.
+            self.assertEqual(os.stat(self.snapshot).st_mtime_ns, self.stamp)
+            yield json.loads(output)
+
+    def test_remove_languages(self):
+        for langs, phonemes, kept in self.change(update = False):
+            self.assertEqual((langs, phonemes, kept), (0, 0, 0))
+
+    def test_update_languages(self):
+        with open(DBASE, encoding = 'utf-8') as inp:
+            nlangs = len(json.load(inp))
+        for langs, phonemes, kept in self.change(update = True):
+            self.assertEqual(langs, nlangs)
+            self.assertEqual(kept, phonemes)
+
+class UntrustedSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'phono_dbase.snapshot')
+        self.marker = os.path.join(self.directory, 'unpickled')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_header_is_not_unpickled(self):
+        # A pickle which creates a directory when loaded, where the header
+        # should be: it must be rejected without being unpickled.
+        with open(self.snapshot, 'wb') as out:
+            out.write(pickle.dumps(_MakeDirectory(self.marker)))
+        run(BUILD, 1, dbase = DBASE, snapshot = self.snapshot)
+        self.assertFalse(os.path.exists(self.marker))
+
+class _MakeDirectory:
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (os.mkdir, (self.path,))
+
+if __name__ == '__main__':
+    unittest.main()